@@ -39,24 +39,139 @@
 #
 # - class: allows defining classnames in methods
 # - method: method declaration is gone to the header file, implementation - to implementation file
+#           method inline/hot/cold/noinline: same, with the given options (they can be combined)
+#           For template methods ('template <...>' in front of the method) the definition stays
+#           in the header, unless it is followed by 'instantiate ARGS...': then it goes to the
+#           implementation file with explicit instantiations for each ARGS (e.g. int or
+#           "std::string, 4"; trailing parameters with defaults may be left out), and
+#           'extern template' declarations end the header namespace
+# - inline: same as method, but the definition stays in the class body in the header file
+# - hot/cold/noinline: same as method, with [[gnu::hot]]/[[gnu::cold]]/[[gnu::noinline]] on the
+#                      declaration and the definition
 # - main: same as method, but always generates static methods and also generates a global main function
 #         which will call the method
 # - constructor: allows defining class constructors
 # - destructor: allows defining class destructors
 
+# Library usage
+# cmacs can be imported without side effects; every call keeps its own parser state
+# - translate(text, namespace=None, name='cmacs.cm.cpp') -> (hpp, cpp)
+# - translate_file(path, namespace=None, here=False, write=False) -> (hpp, cpp)
+# - read_ir(text, name='cmacs.cm.cpp') -> ir: the parsed intermediate representation, JSON serializable
+# - emit_ir(ir, namespace=None, name='cmacs.cm.cpp') -> (hpp, cpp): outputs from an ir without parsing again
+# - main(argv=None): the command line interface
+# - serve(options, socket_path=None): the --serve worker, see cmacs_client.py for a client
+# - watch(dirs, options): the --watch loop, regenerating inputs under dirs as they change
+
+# Modules only some modes need are imported where they are used, which keeps
+# the startup of single-file runs (one per build edge) short
 import argparse
+import array
+import collections
+import glob
+import hashlib
+import io
+import itertools
+import json
+import locale
+import mmap
 import os.path
 import shlex
+import stat
+import sys
 import re
+import threading
+import time
+
+VERSION = '0.2.0'
+
+# The readers below never look at more than a handful of characters: brackets
+# (which are tracked on the symbol stack) and whitespace (which separates the
+# parts of a method signature). Everything in between is skipped in bulk
+WHITESPACE = ' \t\r\n'
+BRACKETS = re.compile(r'[{}()\[\]]')
+DELIMITERS = re.compile(r'[{}()\[\] \t\r\n]')
+NON_WHITESPACE = re.compile(r'[^ \t\r\n]')
+IDENTIFIER = re.compile(r'[A-Za-z_]\w*')
+SIMPLE_VALUE = re.compile(r'[\w:.]+$')
+TEMPLATE = re.compile(r'\s*template\s*<')
+INCLUDE = re.compile(r'#\s*include\s*([<"])([^>"]+)[>"]')
+INCLUDES = re.compile(r'^[ \t]*#[ \t]*include\b', re.M)
+
+# Brackets (group 1) along with whole comments and literals, whose contents
+# must not be counted. Block comments and raw strings that do not end on the
+# line match up to its end (groups 2 and 4; group 3 is the delimiter of a raw
+# string). Every alternative starts with a fixed character, and prefixes are
+# checked behind the quote, so other characters are passed over quickly. A
+# quote right after a word character is a digit separator as in 1'000, unless
+# the word is a character literal prefix
+TOKENS = re.compile(
+  r'([{}()\[\]])|/(?:/.*|\*.*?\*/|(\*).*)'
+  r'|"(?:(?:(?<=\bR")|(?<=\b[uUL]R")|(?<=\bu8R"))([^()\\\s]{0,16})\((?:.*?\)\3"|(.*))|[^"\\]*(?:\\.[^"\\]*)*"?)'
+  r"|'(?:(?<!\w')|(?<=\b[uUL]')|(?<=\bu8'))[^'\\]*(?:\\.[^'\\]*)*'?")
 
 # Args:
 # #pragma cmacs namespace Foo
 #                         0
 
-SYM_STACK = []
-CLASS_STACK = []
+# Symbol stack codes: a pragma frame, or the closing bracket that is expected
+FRAME = 0
+BRACE = 1
+PAREN = 2
+BRACKET = 3
+CODES = {'}': BRACE, ')': PAREN, ']': BRACKET}
+CLOSERS = '\0})]'
+
+
+class CMacsStack:
+  # Brackets and pragma frames, innermost last. Brackets are only stored as
+  # codes in an array; frames are FRAME codes whose pragma objects are kept in
+  # a separate list, and every pragma remembers where its frame is, so
+  # finding and unwinding to it do not have to search the stack
+  __slots__ = ('codes', 'frames')
+
+  def __init__(self):
+    self.codes = array.array('B')
+    self.frames = []
+
+  def __len__(self):
+    return len(self.codes)
+
+  def push_frame(self, pragma):
+    pragma.depth = len(self.codes)
+    pragma.frame = len(self.frames)
+    self.codes.append(FRAME)
+    self.frames.append(pragma)
+
+  def pop(self):
+    if self.codes.pop() == FRAME:
+      self.frames.pop()
+
+  def top(self):
+    if self.codes[-1] == FRAME:
+      return self.frames[-1]
+    return CLOSERS[self.codes[-1]]
+
+  def unwind(self, pragma):
+    # Drops pragma's frame and everything above it
+    if pragma.frame >= len(self.frames) or self.frames[pragma.frame] is not pragma:
+      raise RuntimeError('Invalid stack: no self')
+    del self.codes[pragma.depth:len(self.codes)]
+    del self.frames[pragma.frame:len(self.frames)]
+
+  def to_list(self):
+    frames = iter(self.frames)
+    return [next(frames) if code == FRAME else CLOSERS[code] for code in self.codes]
+
+  def __repr__(self):
+    return repr(self.to_list())
+
 
 class CMacsPragma:
+  # depth is the position of the pragma's frame in the symbol stack while it
+  # is reading, frame its position among the frames
+  __slots__ = ('file', 'depth', 'frame')
+
   def __init__(self, file):
     self.file = file
     pass
@@ -65,44 +180,91 @@ class CMacsPragma:
     pass
   
   def readblock(self):
-    SYM_STACK.append(self)
+    stack = self.file.sym_stack
+    stack.push_frame(self)
+    codes = stack.codes
+    own = len(codes)
     line = self.file.next()
     data = []
     if line[0] != '{':
       raise RuntimeError('Expected block, found something else')
-    line = line[1:len(line)]
+    begin = 1
     while line != None:
-      idx = 0
-      while idx < len(line):
-        c = line[idx]
-        if c == '}' and type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-            left = '' if idx == 0 else line[0:idx-1]
-            right = '' if idx >= len(line) - 1 else line[idx+1:len(line)]
-            data.append(left.strip() + '\n')
-            self.file.insert(right.strip() + '\n')
-            line = None
-            break
-        else:
-          self.file.handle_char(c)
-        idx += 1
+      for m in self.file.brackets(line, begin):
+        c = m.group()
+        if c == '}' and len(codes) == own:
+          idx = m.start()
+          left = '' if idx == begin else line[begin:idx-1]
+          data.append(left.strip() + '\n')
+          self.file.resume(idx + 1)
+          line = None
+          break
+        self.file.handle_char(c)
       if line != None:
-        data.append(line.strip() + '\n')
+        data.append(line[begin:len(line)].strip() + '\n')
         line = self.file.next()
-    if not (True in [type(e) is type(self) for e in SYM_STACK]):
-      raise RuntimeError('Invalid stack: no self')
-    while type(SYM_STACK[len(SYM_STACK)-1]) is not type(self):
-      SYM_STACK.pop()
-    SYM_STACK.pop()
+        begin = 0
+    stack.unwind(self)
     return data
 
   def readclass(self):
     line = self.file.peek_next().strip()
-    c = re.compile(r'^(?:class|struct) (.+?)(?:\s+{?|$)')
+    c = re.compile(r'^(class|struct) (.+?)(?:\s+{?|$)')
     m = c.match(line)
-    self.classname = m.group(1)
-    SYM_STACK.append(self)
-    CLASS_STACK.append(self)
-    return self
+    self.classname = m.group(2)
+    # Only classes that are not nested in another one can be forward
+    # declared; class_stack is not unwound, so ask the symbol stack
+    outer = [f for f in self.file.sym_stack.frames if type(f) is CMacsClassPragma]
+    name = IDENTIFIER.match(self.classname)
+    forward = None
+    if len(outer) == 0 and name != None:
+      forward = name.group()
+    self.file.sym_stack.push_frame(self)
+    self.file.class_stack.append(self)
+    return {'keyword': m.group(1), 'name': self.classname, 'forward': forward}
+
+  def readtemplate(self):
+    # Consumes a 'template <...>' header in front of a method; returns it
+    # along with the names of its parameters (and whether they are packs),
+    # which of them take values and their default arguments, or None if there
+    # is none
+    line = self.file.peek_next()
+    if line == None or TEMPLATE.match(line) == None:
+      return None
+    line = self.file.next()
+    begin = TEMPLATE.match(line).end()
+    depth = 1
+    parens = 0
+    idx = begin
+    while depth > 0:
+      if idx >= len(line):
+        raise RuntimeError('Unterminated template parameter list')
+      c = line[idx]
+      if c == '(':
+        parens += 1
+      elif c == ')':
+        parens -= 1
+      elif c == '<' and parens == 0:
+        depth += 1
+      elif c == '>' and parens == 0:
+        depth -= 1
+      idx += 1
+    self.file.resume(idx)
+    params = []
+    values = []
+    defaults = []
+    plain = []
+    for param in split_top_level(line[begin:idx-1]):
+      decl = split_top_level(param, '=')[0]
+      names = IDENTIFIER.findall(decl)
+      params.append((names[-1] if len(names) > 0 else '', '...' in param))
+      values.append(len(names) == 0 or names[0] not in ('typename', 'class', 'template'))
+      default = param[len(decl):len(param)].strip()
+      defaults.append(default[1:len(default)].strip() if default != '' else None)
+      plain.append(decl)
+    # Default arguments may only be given once, so the out-of-class
+    # definition gets the header without them
+    return {'header': line[0:idx].strip(), 'definition': 'template <' + ', '.join(plain) + '>', 'params': params, 'values': values, 'defaults': defaults}
 
   def readmethod(self, destructor=False):
     mode_readtypews = 0
@@ -117,104 +279,126 @@ class CMacsPragma:
     mode = mode_readtypews
     if destructor:
       mode = mode_readnamews
-    mtype = ''
-    mname = ''
-    margs = ''
-    mbody = ''
+    mtype = []
+    mname = []
+    margs = []
+    mbody = []
     mvirtual = False
     mstatic = False
-    SYM_STACK.append(self)
+    handle_char = self.file.handle_char
+    stack = self.file.sym_stack
+    stack.push_frame(self)
+    codes = stack.codes
+    own = len(codes)
     try:
       line = self.file.next()
       ls = line.strip()
       while line != None:
         idx = 0
-        while idx < len(line):
-          nohandle = False
-          c = line[idx]
-          if mode == mode_readtypews:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+        shift = 0
+        end = len(line)
+        while idx < end:
+          if mode == mode_readbody:
+            for m in self.file.brackets(line, idx):
+              c = m.group()
+              if c == '}' and len(codes) == own + 1:
+                mbody.append(line[idx:m.start()])
+                codes.pop()
+                self.file.resume(m.end() + shift)
+                line = None
+                break
+              handle_char(c)
+            else:
+              mbody.append(line[idx:end])
+            break
+          elif mode == mode_readargs:
+            m = next(self.file.brackets(line, idx), None)
+            if m == None:
+              margs.append(line[idx:end])
+              break
+            margs.append(line[idx:m.start()])
+            idx = m.start()
+            c = line[idx]
+            if c == ')' and len(codes) == own:
+              mode = mode_readbodylbracews
+            else:
+              margs.append(c)
+              handle_char(c)
+          elif mode == mode_readtype or mode == mode_readname:
+            acc = mtype if mode == mode_readtype else mname
+            m = DELIMITERS.search(line, idx)
+            if m == None:
+              acc.append(line[idx:end])
+              break
+            acc.append(line[idx:m.start()])
+            idx = m.start()
+            c = line[idx]
+            if c in WHITESPACE:
+              if len(codes) == own:
+                if mode == mode_readname:
+                  mode = mode_readargslparenws
+                elif ''.join(mtype) == 'virtual':
+                  mvirtual = True
+                  mtype = []
+                  mode = mode_readtypews
+                elif ''.join(mtype) == 'static':
+                  mstatic = True
+                  mtype = []
+                  mode = mode_readtypews
+                else:
+                  mode = mode_readnamews
+            elif c == '(' and mode == mode_readname:
+              if len(codes) == own:
+                mode = mode_readargs
+            else:
+              acc.append(c)
+              handle_char(c)
+          elif mode == mode_readnamews and destructor and ls.startswith('virtual'):
+            # The line is re-read without the keyword; shift keeps resume()
+            # pointing into the line the reader handed out
+            shift += len(line) - len(line.lstrip()) + len('virtual')
+            line = ls[len('virtual'):len(ls)]
+            ls = line
+            end = len(line)
+            mvirtual = True
+            continue
+          else:
+            # Whitespace-skipping modes
+            m = NON_WHITESPACE.search(line, idx)
+            if m == None:
+              break
+            idx = m.start()
+            c = line[idx]
+            if mode == mode_readtypews:
               mode = mode_readtype
               continue
-          elif mode == mode_readnamews:
-            if destructor and ls.startswith('virtual'):
-              line = ls[len('virtual'):len(ls)]
-              ls = line
-              mvirtual = True
-              continue
-            elif not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+            elif mode == mode_readnamews:
               mode = mode_readname
               continue
-          elif mode == mode_readargslparenws:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+            elif mode == mode_readargslparenws:
               mode = mode_readargslparen
               continue
-          elif mode == mode_readbodylbracews:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+            elif mode == mode_readargslparen:
+              if c == '(':
+                mode = mode_readargs
+              else:
+                raise RuntimeError('Expected (, got ' + c)
+            elif mode == mode_readbodylbracews:
               if c == '{':
                 mode = mode_readbody
+                handle_char(c)
               else:
                 raise RuntimeError('Expected whitespace or {, got ' + c)
-          elif mode == mode_readtype:
-            if (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                if mtype == 'virtual':
-                  mvirtual = True
-                  mtype = ''
-                  mode = mode_readtypews
-                elif mtype == 'static':
-                  mstatic = True
-                  mtype = ''
-                  mode = mode_readtypews
-                else:
-                  mode = mode_readnamews
-            else:
-              mtype += c
-          elif mode == mode_readname:
-            if (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                mode = mode_readargslparenws
-            elif c == '(':
-              nohandle = True
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                mode = mode_readargs
-            else:
-              mname += c
-          elif mode == mode_readargslparen:
-            nohandle = True
-            if c == '(':
-              mode = mode_readargs
-            else:
-              raise RuntimeError('Expected (, got ' + c)
-          elif mode == mode_readargs:
-            if c == ')' and type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-              nohandle = True
-              mode = mode_readbodylbracews
-            else:
-              margs += c
-          elif mode == mode_readbody:
-            if c == '}' and type(SYM_STACK[len(SYM_STACK)-2]) is type(self):
-              SYM_STACK.pop()
-              nohandle = True
-              line = None
-              break
-            else:
-              mbody += c
-          if not nohandle: self.file.handle_char(c)
           idx += 1
         if line != None:
           line = self.file.next()
     finally:
-      if not (True in [type(e) is type(self) for e in SYM_STACK]):
-        raise RuntimeError('Invalid stack: no self')
-      while type(SYM_STACK[len(SYM_STACK)-1]) is not type(self):
-        SYM_STACK.pop()
-      SYM_STACK.pop()
+      stack.unwind(self)
     return {
-      'mtype': mtype,
-      'mname': mname,
-      'margs': margs,
-      'mbody': mbody,
+      'mtype': ''.join(mtype),
+      'mname': ''.join(mname),
+      'margs': ''.join(margs),
+      'mbody': ''.join(mbody),
       'mvirtual': mvirtual,
       'mstatic': mstatic,
     }
@@ -230,104 +414,154 @@ class CMacsPragma:
     mode_readbodylbracews = 8
     mode_readbody = 9
     mode = mode_readnamews
-    mname = ''
-    margs = ''
-    mbody = ''
-    minitname = ''
-    minitargs = ''
+    mname = []
+    margs = []
+    mbody = []
+    minitname = []
+    minitargs = []
     minit = []
-    SYM_STACK.append(self)
+    handle_char = self.file.handle_char
+    stack = self.file.sym_stack
+    stack.push_frame(self)
+    codes = stack.codes
+    own = len(codes)
     try:
       line = self.file.next()
       while line != None:
         idx = 0
-        while idx < len(line):
-          nohandle = False
-          c = line[idx]
-          if mode == mode_readnamews:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+        end = len(line)
+        while idx < end:
+          if mode == mode_readbody:
+            for m in self.file.brackets(line, idx):
+              c = m.group()
+              if c == '}' and len(codes) == own + 1:
+                mbody.append(line[idx:m.start()])
+                codes.pop()
+                self.file.resume(m.end())
+                line = None
+                break
+              handle_char(c)
+            else:
+              mbody.append(line[idx:end])
+            break
+          elif mode == mode_readargs or mode == mode_readinitargs:
+            acc = margs if mode == mode_readargs else minitargs
+            m = next(self.file.brackets(line, idx), None)
+            if m == None:
+              acc.append(line[idx:end])
+              break
+            acc.append(line[idx:m.start()])
+            idx = m.start()
+            c = line[idx]
+            if c == ')' and len(codes) == own:
+              if mode == mode_readinitargs:
+                minit.append((''.join(minitname) + '(' + ''.join(minitargs) + ')').strip())
+                minitname = []
+                minitargs = []
+              mode = mode_readbodylbracews
+            else:
+              acc.append(c)
+              handle_char(c)
+          elif mode == mode_readinitname:
+            m = next(self.file.brackets(line, idx), None)
+            if m == None:
+              minitname.append(line[idx:end])
+              break
+            minitname.append(line[idx:m.start()])
+            idx = m.start()
+            c = line[idx]
+            if c == '(':
+              if len(codes) == own:
+                mode = mode_readinitargs
+              else:
+                handle_char(c)
+            else:
+              minitname.append(c)
+              handle_char(c)
+          elif mode == mode_readname:
+            m = DELIMITERS.search(line, idx)
+            if m == None:
+              mname.append(line[idx:end])
+              break
+            mname.append(line[idx:m.start()])
+            idx = m.start()
+            c = line[idx]
+            if c in WHITESPACE:
+              if len(codes) == own:
+                mode = mode_readargslparenws
+            elif c == '(':
+              if len(codes) == own:
+                mode = mode_readargs
+            else:
+              mname.append(c)
+              handle_char(c)
+          else:
+            # Whitespace-skipping modes
+            m = NON_WHITESPACE.search(line, idx)
+            if m == None:
+              break
+            idx = m.start()
+            c = line[idx]
+            if mode == mode_readnamews:
               mode = mode_readname
               continue
-          elif mode == mode_readargslparenws:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+            elif mode == mode_readargslparenws:
               mode = mode_readargslparen
               continue
-          elif mode == mode_readbodylbracews:
-            if not (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
+            elif mode == mode_readargslparen:
+              if c == '(':
+                mode = mode_readargs
+              else:
+                raise RuntimeError('Expected (, got ' + c)
+            elif mode == mode_readbodylbracews:
               if c == '{':
                 mode = mode_readbody
+                handle_char(c)
               elif c == ':' or c == ',':
                 mode = mode_readinitname
                 continue
               else:
                 raise RuntimeError('Expected whitespace or {, got ' + c)
-          elif mode == mode_readname:
-            if (c == ' ' or c == '\t' or c == '\r' or c == '\n'):
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                mode = mode_readargslparenws
-            elif c == '(':
-              nohandle = True
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                mode = mode_readargs
-            else:
-              mname += c
-          elif mode == mode_readargslparen:
-            nohandle = True
-            if c == '(':
-              mode = mode_readargs
-            else:
-              raise RuntimeError('Expected (, got ' + c)
-          elif mode == mode_readargs:
-            if c == ')' and type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-              nohandle = True
-              mode = mode_readbodylbracews
-            else:
-              margs += c
-          elif mode == mode_readinitname:
-            if c == '(':
-              if type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-                nohandle = True
-                mode = mode_readinitargs
-            else:
-              minitname += c
-          elif mode == mode_readinitargs:
-            if c == ')' and type(SYM_STACK[len(SYM_STACK)-1]) is type(self):
-              nohandle = True
-              mode = mode_readbodylbracews
-              minit.append((minitname + '(' + minitargs + ')').strip())
-              minitname = ''
-              minitargs = ''
-            else:
-              minitargs += c
-          elif mode == mode_readbody:
-            if c == '}' and type(SYM_STACK[len(SYM_STACK)-2]) is type(self):
-              SYM_STACK.pop()
-              nohandle = True
-              line = None
-              break
-            else:
-              mbody += c
-          if not nohandle: self.file.handle_char(c)
           idx += 1
         if line != None:
           line = self.file.next()
     finally:
-      if not (True in [type(e) is type(self) for e in SYM_STACK]):
-        raise RuntimeError('Invalid stack: no self')
-      while type(SYM_STACK[len(SYM_STACK)-1]) is not type(self):
-        SYM_STACK.pop()
-      SYM_STACK.pop()
+      stack.unwind(self)
     return {
-      'mname': mname,
-      'margs': margs,
-      'mbody': mbody,
+      'mname': ''.join(mname),
+      'margs': ''.join(margs),
+      'mbody': ''.join(mbody),
       'minit': minit,
     }
 
+
+def split_top_level(text, sep=','):
+  # Splits text at sep where it is not nested in <>, () or []
+  parts = []
+  depth = 0
+  last = 0
+  for idx, c in enumerate(text):
+    if c in '<([':
+      depth += 1
+    elif c in '>)]':
+      depth -= 1
+    elif c == sep and depth == 0:
+      parts.append(text[last:idx])
+      last = idx + 1
+  parts.append(text[last:len(text)])
+  return [part.strip() for part in parts if part.strip() != '']
+
+
 pragmas = {}
 
+# Emitters apply records of the intermediate representation (see
+# CMacsFile.emit) to the output sections, keyed by the record kind
+emitters = {}
+
 
 class CMacsNOPPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
 
@@ -335,257 +569,1000 @@ pragmas['nop'] = lambda file, args: CMacsNOPPragma(file)
 
 
 class CMacsHPPStartPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.hppstart = self.readblock() + self.file.hppstart
+    self.file.emit({'kind': 'block', 'section': 'hppstart', 'lines': self.readblock()})
 
 pragmas['hppstart'] = lambda file, args: CMacsHPPStartPragma(file)
 pragmas['includes'] = pragmas['hppstart']
 
 
 class CMacsHPPPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.hppbody = self.readblock() + self.file.hppbody
+    self.file.emit({'kind': 'block', 'section': 'hppbody', 'lines': self.readblock()})
 
 pragmas['hppbody'] = lambda file, args: CMacsHPPPragma(file)
 pragmas['hpp'] = pragmas['hppbody']
 
 
 class CMacsHPPEndPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.hppend = self.readblock() + self.file.hppend
+    self.file.emit({'kind': 'block', 'section': 'hppend', 'lines': self.readblock()})
 
 pragmas['hppend'] = lambda file, args: CMacsHPPEndPragma(file)
 
 
 class CMacsCPPStartPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.cppstart = self.readblock() + self.file.cppstart
+    self.file.emit({'kind': 'block', 'section': 'cppstart', 'lines': self.readblock()})
 
 pragmas['cppstart'] = lambda file, args: CMacsCPPStartPragma(file)
 
 
 class CMacsCPPPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.cppbody = self.readblock() + self.file.cppbody
+    self.file.emit({'kind': 'block', 'section': 'cppbody', 'lines': self.readblock()})
 
 pragmas['cppbody'] = lambda file, args: CMacsCPPPragma(file)
 pragmas['cpp'] = pragmas['cppbody']
 
 
 class CMacsCPPEndPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
   
   def execute(self):
-    self.file.cppend = self.readblock() + self.file.cppend
+    self.file.emit({'kind': 'block', 'section': 'cppend', 'lines': self.readblock()})
 
 pragmas['cppend'] = lambda file, args: CMacsCPPEndPragma(file)
 
+
+def emit_block(file, record):
+  if record['section'] == 'hppstart' or record['section'] == 'cppstart':
+    file.add_includes(record['lines'])
+  getattr(file, record['section']).prepend(record['lines'])
+
+emitters['block'] = emit_block
+
+
 class CMacsNamespacePragma(CMacsPragma):
+  __slots__ = ('namespace',)
+
   def __init__(self, file, namespace):
     super().__init__(file)
     self.namespace = namespace
   
   def execute(self):
-    self.file.namespace = self.namespace
+    self.file.emit({'kind': 'namespace', 'name': self.namespace})
 
 pragmas['namespace'] = lambda file, args: CMacsNamespacePragma(file, args[0])
 
 
+def emit_namespace(file, record):
+  file.namespace = record['name']
+
+emitters['namespace'] = emit_namespace
+
+
 class CMacsClassPragma(CMacsPragma):
+  __slots__ = ('classname',)
+
   def __init__(self, file):
     super().__init__(file)
 
   def execute(self):
-    self.readclass()
+    record = self.readclass()
+    record['kind'] = 'class'
+    self.file.emit(record)
 
 pragmas['class'] = lambda file, args: CMacsClassPragma(file)
 
 
+def emit_class(file, record):
+  if record['forward'] != None:
+    file.forward.append((record['keyword'], record['forward']))
+
+emitters['class'] = emit_class
+
+
+METHOD_ATTRIBUTES = {
+  'hot': '[[gnu::hot]] ',
+  'cold': '[[gnu::cold]] ',
+  'noinline': '[[gnu::noinline]] ',
+}
+
 class CMacsMethodPragma(CMacsPragma):
-  def __init__(self, file):
+  __slots__ = ('inline', 'attributes', 'instantiate')
+
+  def __init__(self, file, args=[]):
     super().__init__(file)
+    self.inline = 'inline' in args
+    self.attributes = ''
+    self.instantiate = None
+    for i, arg in enumerate(args):
+      if arg in METHOD_ATTRIBUTES:
+        self.attributes += METHOD_ATTRIBUTES[arg]
+      elif arg == 'instantiate':
+        # Everything after it are template argument lists, one per
+        # instantiation, e.g. 'instantiate int "std::string, 4"'
+        self.instantiate = args[i+1:len(args)]
+        break
+      elif arg != 'inline':
+        raise RuntimeError('Unknown method option ' + arg)
+    if self.inline and 'noinline' in args:
+      raise RuntimeError('A method cannot be both inline and noinline')
+    if self.instantiate != None and (self.inline or len(self.instantiate) == 0):
+      raise RuntimeError('instantiate needs a list of template arguments and cannot be inline')
   
   def execute(self):
+    template = self.readtemplate()
     method = self.readmethod()
-    classes = '::'.join(c.classname for c in CLASS_STACK)
-    v = 'virtual ' if method['mvirtual'] else ''
-    s = 'static ' if method['mstatic'] else ''
-    self.file.hppbody.append(v + s + method['mtype'] + ' ' + method['mname'] + ' (' + method['margs'] + ');\n')
-    self.file.cppbody.append(method['mtype'] + ' ' + classes + '::' + method['mname'] + ' (' + method['margs'] + ') {')
-    self.file.cppbody.append(method['mbody'])
-    self.file.cppbody.append('}\n')
-
-pragmas['method'] = lambda file, args: CMacsMethodPragma(file)
+    if template == None and self.instantiate != None:
+      raise RuntimeError('instantiate used on a method that is not a template')
+    self.file.emit({
+      'kind': 'method',
+      'classes': '::'.join(c.classname for c in self.file.class_stack),
+      'method': method,
+      'template': template,
+      'inline': self.inline,
+      'attributes': self.attributes,
+      'instantiate': self.instantiate,
+    })
+
+pragmas['method'] = lambda file, args: CMacsMethodPragma(file, args)
+pragmas['inline'] = lambda file, args: CMacsMethodPragma(file, ['inline'] + args)
+pragmas['hot'] = lambda file, args: CMacsMethodPragma(file, ['hot'] + args)
+pragmas['cold'] = lambda file, args: CMacsMethodPragma(file, ['cold'] + args)
+pragmas['noinline'] = lambda file, args: CMacsMethodPragma(file, ['noinline'] + args)
+
+
+def emit_method(file, record):
+  method = record['method']
+  classes = record['classes']
+  template = record['template']
+  v = 'virtual ' if method['mvirtual'] else ''
+  s = 'static ' if method['mstatic'] else ''
+  a = record['attributes']
+  t = ''
+  td = ''
+  if template != None:
+    t = template['header'] + ' '
+    td = template['definition'] + ' '
+  if record['inline'] or (template != None and record['instantiate'] == None):
+    # Defined in the class body, which makes it implicitly inline; without
+    # explicit instantiations templates have to stay in the header anyway
+    file.hppbody.append(t + a + v + s + method['mtype'] + ' ' + method['mname'] + ' (' + method['margs'] + ') {')
+    file.hppbody.append(method['mbody'])
+    file.hppbody.append('}\n')
+    return
+  file.hppbody.append(t + a + v + s + method['mtype'] + ' ' + method['mname'] + ' (' + method['margs'] + ');\n')
+  file.cppbody.mark(classes)
+  file.cppbody.append(td + a + method['mtype'] + ' ' + classes + '::' + method['mname'] + ' (' + method['margs'] + ') {')
+  file.cppbody.append(method['mbody'])
+  file.cppbody.append('}\n')
+  if record['instantiate'] != None:
+    emit_instantiations(file, template, method, classes, record['instantiate'])
+
+
+def emit_instantiations(file, template, method, classes, instantiate):
+  # Explicit instantiation definitions go to the implementation file and
+  # matching declarations to the end of the header, so that includers do
+  # not instantiate the template themselves
+  params = template['params']
+  defaults = template['defaults']
+  if True in [variadic for name, variadic in params]:
+    raise RuntimeError('instantiate does not support variadic templates')
+  # Trailing parameters with default arguments may be left out
+  required = len(params)
+  while required > 0 and defaults[required-1] != None:
+    required -= 1
+  for arg in instantiate:
+    values = split_top_level(arg)
+    if len(values) < required or len(values) > len(params):
+      expected = str(len(params)) if required == len(params) else str(required) + ' to ' + str(len(params))
+      raise RuntimeError('Expected ' + expected + ' template arguments, got ' + arg)
+    names = {}
+    subst = lambda text: IDENTIFIER.sub(lambda m: names.get(m.group(), m.group()), text)
+    for i, (name, variadic) in enumerate(params):
+      # Defaults may refer to the parameters before them
+      if i == len(values):
+        values.append(subst(defaults[i]))
+      if name == '':
+        continue
+      names[name] = values[i]
+      # Values end up in expressions such as 'N * 2'
+      if template['values'][i] and SIMPLE_VALUE.match(values[i]) == None:
+        names[name] = '(' + values[i] + ')'
+    targs = ', '.join(values)
+    if targs.endswith('>'):
+      targs += ' '
+    decl = subst(method['mtype']) + ' ' + classes + '::' + method['mname'] + '<' + targs + '> (' + subst(method['margs']) + ');\n'
+    file.cppbody.append('template ' + decl)
+    file.hppextern.append('extern template ' + decl)
+
+emitters['method'] = emit_method
 
 
 class CMacsMainPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
 
   def execute(self):
     method = self.readmethod()
-    classes = '::'.join(c.classname for c in CLASS_STACK)
-    self.file.hppbody.append('static ' + method['mtype'] + ' ' + method['mname'] + ' (' + method['margs'] + ');\n')
-    self.file.cppbody.append(method['mtype'] + ' ' + classes + '::' + method['mname'] + ' (' + method['margs'] + ') {')
-    self.file.cppbody.append(method['mbody'])
-    self.file.cppbody.append('}\n')
-    self.file.cppend.append('int main(int argc, char** argv) { return ::' + self.file.namespace + '::' + classes + '::' + method['mname'] + '(argc, argv); }')
+    self.file.emit({'kind': 'main', 'classes': '::'.join(c.classname for c in self.file.class_stack), 'method': method})
 
 pragmas['main'] = lambda file, args: CMacsMainPragma(file)
 
 
+def emit_main(file, record):
+  method = record['method']
+  classes = record['classes']
+  file.hppbody.append('static ' + method['mtype'] + ' ' + method['mname'] + ' (' + method['margs'] + ');\n')
+  file.cppbody.mark(classes)
+  file.cppbody.append(method['mtype'] + ' ' + classes + '::' + method['mname'] + ' (' + method['margs'] + ') {')
+  file.cppbody.append(method['mbody'])
+  file.cppbody.append('}\n')
+  file.has_main = True
+  file.cppend.append('int main(int argc, char** argv) { return ::' + file.namespace + '::' + classes + '::' + method['mname'] + '(argc, argv); }')
+
+emitters['main'] = emit_main
+
+
 class CMacsConstructorPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
 
   def execute(self):
     constructor = self.readconstructor()
-    classes = '::'.join(c.classname for c in CLASS_STACK)
-    self.file.hppbody.append(constructor['mname'] + ' (' + constructor['margs'] + ');\n')
-    self.file.cppbody.append(classes + '::' + constructor['mname'] + ' (' + constructor['margs'] + ')\n')
-    if len(constructor['minit']) >= 1:
-      self.file.cppbody.append(constructor['minit'][0] + '\n')
-      for minit in constructor['minit'][1:len(constructor['minit'])]:
-        self.file.cppbody.append(minit + '\n')
-    self.file.cppbody.append('{')
-    self.file.cppbody.append(constructor['mbody'])
-    self.file.cppbody.append('}\n')
+    self.file.emit({'kind': 'constructor', 'classes': '::'.join(c.classname for c in self.file.class_stack), 'constructor': constructor})
 
 pragmas['constructor'] = lambda file, args: CMacsConstructorPragma(file)
 
 
+def emit_constructor(file, record):
+  constructor = record['constructor']
+  classes = record['classes']
+  file.hppbody.append(constructor['mname'] + ' (' + constructor['margs'] + ');\n')
+  file.cppbody.mark(classes)
+  file.cppbody.append(classes + '::' + constructor['mname'] + ' (' + constructor['margs'] + ')\n')
+  if len(constructor['minit']) >= 1:
+    file.cppbody.append(constructor['minit'][0] + '\n')
+    for minit in constructor['minit'][1:len(constructor['minit'])]:
+      file.cppbody.append(minit + '\n')
+  file.cppbody.append('{')
+  file.cppbody.append(constructor['mbody'])
+  file.cppbody.append('}\n')
+
+emitters['constructor'] = emit_constructor
+
+
 class CMacsDestructorPragma(CMacsPragma):
+  __slots__ = ()
+
   def __init__(self, file):
     super().__init__(file)
 
   def execute(self):
     method = self.readmethod(True)
-    classes = '::'.join(c.classname for c in CLASS_STACK)
-    v = 'virtual ' if method['mvirtual'] else ''
-    self.file.hppbody.append(v + method['mname'] + ' ();\n')
-    self.file.cppbody.append(classes + '::' + method['mname'] + ' () {\n')
-    self.file.cppbody.append(method['mbody'])
-    self.file.cppbody.append('}\n')
+    self.file.emit({'kind': 'destructor', 'classes': '::'.join(c.classname for c in self.file.class_stack), 'method': method})
 
 pragmas['destructor'] = lambda file, args: CMacsDestructorPragma(file)
 
 
-class CMacsFile:
-  def __init__(self, path, here):
-    self.path = path
-    self.file = open(path, 'r')
-    if here:
-      self.hpppath = os.path.basename(path) + '.hpp'
-      self.cpppath = os.path.basename(path) + '.cpp'
+def emit_destructor(file, record):
+  method = record['method']
+  classes = record['classes']
+  v = 'virtual ' if method['mvirtual'] else ''
+  file.hppbody.append(v + method['mname'] + ' ();\n')
+  file.cppbody.mark(classes)
+  file.cppbody.append(classes + '::' + method['mname'] + ' () {\n')
+  file.cppbody.append(method['mbody'])
+  file.cppbody.append('}\n')
+
+emitters['destructor'] = emit_destructor
+
+
+def emit_text(file, record):
+  file.hppbody.extend(record['lines'])
+
+emitters['text'] = emit_text
+
+
+TMP_COUNTER = itertools.count()
+
+def temp_path(path):
+  # Hidden sibling of path that keeps its extension, so that tools looking at
+  # the name (clang-format picks the language and style from it) see the same
+  # thing as for path itself
+  dir, base = os.path.split(path)
+  return os.path.join(dir, '.cmacs-' + str(os.getpid()) + '-' + str(next(TMP_COUNTER)) + '-' + base)
+
+
+def write_if_changed(path, data):
+  # Replaces path atomically through a temporary sibling, but only when the
+  # content differs, so unchanged outputs keep their mtimes
+  try:
+    with open(path, 'r') as f:
+      if f.read() == data:
+        return False
+  except (OSError, UnicodeDecodeError):
+    pass
+  tmp = temp_path(path)
+  fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+  return True
+
+
+class CMacsWriter:
+  # Destination of the outputs: with check=False they are written to disk,
+  # with check=True they are only compared to the files on disk, collecting
+  # a unified diff for each one that is out of date. Outputs can also be
+  # redirected to binary streams instead: all of them to stream as frames
+  # (see write_frame), or single ones to the streams in targets, keyed by
+  # the path they would have been written to
+  def __init__(self, check=False, stream=None, targets=None):
+    self.check = check
+    self.stream = stream
+    self.targets = targets or {}
+    self.stale = []
+
+  def write(self, path, data):
+    if self.stream != None:
+      write_frame(self.stream, path, data)
+      return True
+    if path in self.targets:
+      self.targets[path].write(data.encode())
+      return True
+    if not self.check:
+      return write_if_changed(path, data)
+    try:
+      with open(path, 'r') as f:
+        current = f.read()
+    except FileNotFoundError:
+      current = None
+    except (OSError, UnicodeDecodeError):
+      current = ''
+    if current == data:
+      return False
+    import difflib
+    # A missing file is shown as a diff against /dev/null
+    old = path if current != None else '/dev/null'
+    diff = difflib.unified_diff((current or '').splitlines(True), data.splitlines(True), old, path + ' (expected)')
+    # Lines without a trailing newline would run into the next one
+    self.stale.append(''.join(l if l.endswith('\n') else l + '\n\\ No newline at end of file\n' for l in diff))
+    return True
+
+  def remove(self, path):
+    # Redirected outputs never touch the tree
+    if self.stream != None or len(self.targets) != 0:
+      return
+    if not self.check:
+      os.remove(path)
     else:
-      self.hpppath = path + '.hpp'
-      self.cpppath = path + '.cpp'
-    self.hpp = open(self.hpppath, 'w')
-    self.cpp = open(self.cpppath, 'w')
-    self.lines = self.file.readlines()
-    self.line = 0
-    self.namespace = None
-    self.hppstart = []
-    self.hppbody = []
-    self.hppend = []
-    self.cppstart = []
-    self.cppbody = []
-    self.cppend = []
+      self.stale.append(path + ': not generated any more\n')
+
+
+def write_frame(stream, path, data):
+  # One output in a --stdout stream: a '#cmacs SIZE PATH' line followed by
+  # SIZE bytes of UTF-8 content
+  raw = data.encode()
+  stream.write(('#cmacs ' + str(len(raw)) + ' ' + path + '\n').encode())
+  stream.write(raw)
+
+
+def open_target(name):
+  # '-' is stdout, fd:N an inherited file descriptor, anything else a path
+  if name == '-':
+    return sys.stdout.buffer
+  if name.startswith('fd:'):
+    return os.fdopen(int(name[3:len(name)]), 'wb', closefd=False)
+  return open(name, 'wb')
+
+
+FORMAT_BATCH = 64
+
+def format_files(paths, jobs, clang_format='clang-format'):
+  # Formats paths in place with as few clang-format processes as possible,
+  # running the batches concurrently. Returns {path: error} for every path
+  # whose batch failed
+  if len(paths) == 0:
+    return {}
+  import concurrent.futures
+  import subprocess
+  size = min(FORMAT_BATCH, -(-len(paths) // max(jobs, 1)))
+  batches = [paths[i:i+size] for i in range(0, len(paths), size)]
+
+  def run(batch):
+    try:
+      p = subprocess.run([clang_format, '-i'] + batch, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+      return 'Cannot run clang-format: ' + str(e)
+    if p.returncode != 0:
+      return p.stderr.strip() or 'clang-format exited with status ' + str(p.returncode)
+    return None
+
+  failed = {}
+  with concurrent.futures.ThreadPoolExecutor(min(jobs, len(batches))) as pool:
+    for batch, error in zip(batches, pool.map(run, batches)):
+      if error != None:
+        for path in batch:
+          failed[path] = error
+  return failed
+
+
+def clang_format_identity(clang_format):
+  # Changes whenever a different clang-format binary would be picked up
+  import shutil
+  exe = shutil.which(clang_format) or clang_format
+  try:
+    st = os.stat(exe)
+  except OSError:
+    return exe
+  return exe + ':' + str(st.st_size) + ':' + str(st.st_mtime_ns)
+
+
+def clang_format_style(dir):
+  # Identity of the style file clang-format picks up for files in dir: the
+  # nearest .clang-format or _clang-format in dir or one of its parents
+  dir = os.path.abspath(dir)
+  while True:
+    for name in ('.clang-format', '_clang-format'):
+      path = os.path.join(dir, name)
+      try:
+        with open(path, 'rb') as f:
+          return path + ':' + hashlib.sha256(f.read()).hexdigest()
+      except OSError:
+        pass
+    parent = os.path.dirname(dir)
+    if parent == dir:
+      return None
+    dir = parent
+
+
+def format_texts(outputs, jobs, clang_format='clang-format'):
+  # Formats (path, text) pairs through clang-format's stdin, one process per
+  # text, with the style clang-format would pick for path. Returns a
+  # (text, error) pair for each of them
+  if len(outputs) == 0:
+    return []
+  import concurrent.futures
+  import subprocess
+
+  def run(output):
+    path, data = output
+    try:
+      p = subprocess.run([clang_format, '--assume-filename=' + path], input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+      return (None, 'Cannot run clang-format: ' + str(e))
+    if p.returncode != 0:
+      return (None, p.stderr.strip() or 'clang-format exited with status ' + str(p.returncode))
+    return (p.stdout, None)
+
+  with concurrent.futures.ThreadPoolExecutor(min(jobs, len(outputs))) as pool:
+    return list(pool.map(run, outputs))
+
+
+def format_outputs(outputs, options, cache=None, jobs=1):
+  # outputs is a list of (path, text) pairs; returns a (text, error) pair for
+  # each of them. Texts that were formatted before are taken from the cache,
+  # everything else is formatted in batches through temporary siblings, or
+  # through stdin in check mode, which must not write anything
+  results = [None] * len(outputs)
+  keys = [None] * len(outputs)
+  pending = []
+  identity = clang_format_identity(options.clang_format) if cache != None else None
+  styles = {}
+  try:
+    for i, (path, data) in enumerate(outputs):
+      if cache != None:
+        dir = os.path.dirname(os.path.abspath(path))
+        if dir not in styles:
+          styles[dir] = clang_format_style(dir)
+        keys[i] = cache.key('format', identity, styles[dir], os.path.abspath(path), data)
+        value = cache.get(keys[i])
+        if value != None:
+          results[i] = (value['text'], None)
+          continue
+      if options.check:
+        pending.append((i, None))
+        continue
+      tmp = temp_path(path)
+      with open(tmp, 'w') as f:
+        f.write(data)
+      pending.append((i, tmp))
+    if options.check:
+      formatted = format_texts([outputs[i] for i, tmp in pending], jobs, options.clang_format)
+    else:
+      failed = format_files([tmp for i, tmp in pending], jobs, options.clang_format)
+      formatted = []
+      for i, tmp in pending:
+        if tmp in failed:
+          formatted.append((None, failed[tmp]))
+          continue
+        with open(tmp, 'r') as f:
+          formatted.append((f.read(), None))
+    for (i, tmp), (text, error) in zip(pending, formatted):
+      if error != None:
+        results[i] = (None, 'Cannot format ' + outputs[i][0] + ': ' + error)
+        continue
+      results[i] = (text, None)
+      if cache != None and not options.check:
+        cache.put(keys[i], {'text': text})
+  finally:
+    for i, tmp in pending:
+      if tmp == None:
+        continue
+      try:
+        os.unlink(tmp)
+      except FileNotFoundError:
+        pass
+  return results
+
+
+class CMacsSection:
+  # One region of an output file. Block pragmas put their code in front of
+  # everything collected so far while method pragmas add to the end, so
+  # prepended blocks are kept as a list of chunks in reverse order and
+  # appended fragments as a flat list; neither operation copies the section.
+  # Method pragmas mark where their fragments start, so that the appended
+  # part can be split into per-method units
+  __slots__ = ('chunks', 'tail', 'marks', 'prepend', 'append', 'extend')
+
+  def __init__(self):
+    self.chunks = []
+    self.tail = []
+    self.marks = []
+    # Bound list methods, the pragmas call these once per fragment
+    self.prepend = self.chunks.append
+    self.append = self.tail.append
+    self.extend = self.tail.extend
+
+  def __iter__(self):
+    return itertools.chain(itertools.chain.from_iterable(reversed(self.chunks)), self.tail)
+
+  def __len__(self):
+    return sum(len(chunk) for chunk in self.chunks) + len(self.tail)
+
+  def mark(self, key):
+    self.marks.append((len(self.tail), key))
+
+  def blocks(self):
+    return itertools.chain.from_iterable(reversed(self.chunks))
+
+  def units(self):
+    # The appended fragments as (key, fragments) units, split at the marks;
+    # fragments in front of the first mark get the key None
+    units = []
+    last = 0
+    key = None
+    for idx, next_key in self.marks + [(len(self.tail), None)]:
+      if idx > last:
+        units.append((key, self.tail[last:idx]))
+      last = idx
+      key = next_key
+    return units
+
+
+class CMacsReader:
+  # (line, column) cursor over a text stream. Lines are only pulled from the
+  # stream when they are needed, and a reader that stops in the middle of a
+  # line hands the rest back with resume() instead of re-queuing a copy of it
+  def __init__(self, stream):
+    self.stream = stream
+    self.text = ''
+    self.start = 0
+    self.col = None
+    self.ahead = None
+    self.lineno = 0
+    self.chars = 0
+
+  def readline(self):
+    if self.ahead != None:
+      line = self.ahead
+      self.ahead = None
+      return line
+    if self.stream == None:
+      return None
+    line = self.stream.readline()
+    if line == '':
+      self.close()
+      return None
+    return line
+
+  def next(self):
+    if self.col != None:
+      self.start = self.col
+      self.col = None
+      return self.text[self.start:len(self.text)]
+    line = self.readline()
+    if line == None:
+      return None
+    self.text = line
+    self.start = 0
+    self.lineno += 1
+    self.chars += len(line)
+    return line
+
+  def peek_next(self):
+    if self.col != None:
+      return self.text[self.col:len(self.text)]
+    if self.ahead == None:
+      self.ahead = self.readline()
+    return self.ahead
+
+  def resume(self, idx):
+    # idx is relative to the last string returned by next()
+    self.col = self.start + idx
 
   def close(self):
-    self.hpp.write('#pragma once\n')
-    self.hpp.writelines(self.hppstart)
+    if self.stream != None:
+      self.stream.close()
+      self.stream = None
+
+
+class CMacsMappedStream:
+  # Line source for very large inputs: reads through an mmap of the file
+  # instead of buffered reads, decoding one line at a time
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.encoding = locale.getpreferredencoding(False)
+
+  def readline(self):
+    return self.map.readline().decode(self.encoding).replace('\r\n', '\n')
+
+  def close(self):
+    self.map.close()
+
+
+def output_paths(path, here):
+  # here is either a flag (outputs go to the working directory) or the
+  # directory to put them in
+  if here:
+    path = os.path.join(here if isinstance(here, str) else '', os.path.basename(path))
+  return path + '.hpp', path + '.cpp'
+
+
+def shard_path(cpppath, i):
+  # X.cm.cpp.cpp, X.cm.cpp.1.cpp, X.cm.cpp.2.cpp, ...
+  if i == 0:
+    return cpppath
+  return cpppath[0:-len('.cpp')] + '.' + str(i) + '.cpp'
+
+
+def write_outputs(outputs, writer=None):
+  # Writes [(hpppath, hpp), (cpppath, cpp), shards...] and removes shards
+  # left over from an earlier run that produced more of them
+  if writer == None:
+    writer = CMacsWriter()
+  for path, text in outputs:
+    writer.write(path, text)
+  i = len(outputs) - 1
+  while os.path.exists(shard_path(outputs[1][0], i)):
+    writer.remove(shard_path(outputs[1][0], i))
+    i += 1
+
+
+def defers_writes(options):
+  # Whether process_file() leaves writing the outputs to commit_outputs()
+  return options.format or options.pch != None or options.check or redirects_outputs(options)
+
+
+def redirects_outputs(options):
+  return options.stdout or options.hpp_out != None or options.cpp_out != None
+
+
+def fwd_path(path, here):
+  return output_paths(path, here)[0][0:-len('.hpp')] + '.fwd.hpp'
+
+
+class CMacsStats:
+  # Per-pragma counters (count, total and maximum time, characters read and
+  # deepest symbol stack) plus the time spent in each pipeline stage. Stats
+  # of single files are merged into one report for the whole run
+  def __init__(self):
+    self.files = 0
+    self.cached = 0
+    self.stages = {'process': 0.0, 'close': 0.0, 'format': 0.0}
+    self.pragmas = {}
+
+  def add_pragma(self, name, elapsed, chars, depth):
+    p = self.pragmas.get(name)
+    if p == None:
+      p = self.pragmas[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'chars': 0, 'depth': 0}
+    p['count'] += 1
+    p['total'] += elapsed
+    p['max'] = max(p['max'], elapsed)
+    p['chars'] += chars
+    p['depth'] = max(p['depth'], depth)
+
+  def merge(self, other):
+    self.files += other.files
+    self.cached += other.cached
+    for stage, elapsed in other.stages.items():
+      self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+    for name, o in other.pragmas.items():
+      p = self.pragmas.get(name)
+      if p == None:
+        self.pragmas[name] = dict(o)
+        continue
+      p['count'] += o['count']
+      p['total'] += o['total']
+      p['max'] = max(p['max'], o['max'])
+      p['chars'] += o['chars']
+      p['depth'] = max(p['depth'], o['depth'])
+
+  def to_dict(self):
+    return {'files': self.files, 'cached': self.cached, 'stages': self.stages, 'pragmas': self.pragmas}
+
+  def report(self, out):
+    out.write('%-12s %8s %10s %10s %12s %6s\n' % ('pragma', 'count', 'total', 'max', 'chars', 'depth'))
+    for name, p in sorted(self.pragmas.items(), key=lambda e: -e[1]['total']):
+      out.write('%-12s %8d %9.4fs %9.4fs %12d %6d\n' % (name, p['count'], p['total'], p['max'], p['chars'], p['depth']))
+    out.write('files: ' + str(self.files) + ' (' + str(self.cached) + ' from cache)')
+    for stage, elapsed in self.stages.items():
+      out.write(', ' + stage + ': ' + '%.4fs' % elapsed)
+    out.write('\n')
+
+
+class CMacsFile:
+  def __init__(self, path, here=False, data=None, mmap=False, stats=None, namespace=None):
+    self.path = path
+    self.hpppath, self.cpppath = output_paths(path, here)
+    if isinstance(data, str):
+      stream = io.StringIO(data, newline=None)
+    elif data != None:
+      stream = io.TextIOWrapper(io.BytesIO(data))
+    elif mmap and os.path.getsize(path) > 0:
+      stream = CMacsMappedStream(path)
+    else:
+      stream = open(path, 'r')
+    self.reader = CMacsReader(stream)
+    self.stats = stats
+    if stats != None:
+      self.max_depth = 0
+      self.handle_char = self.handle_char_tracked
+    self.sym_stack = CMacsStack()
+    self.class_stack = []
+    self.namespace = namespace
+    self.includes = []
+    self.forward = []
+    self.has_main = False
+    self.ir = []
+    # What ends the comment or raw string the last line ended in, if any
+    self.region = None
+    self.hppstart = CMacsSection()
+    self.hppbody = CMacsSection()
+    self.hppextern = CMacsSection()
+    self.hppend = CMacsSection()
+    self.cppstart = CMacsSection()
+    self.cppbody = CMacsSection()
+    self.cppend = CMacsSection()
+
+  def hpp_fragments(self):
+    yield '#pragma once\n'
+    yield from self.hppstart
     if self.namespace != None:
-      self.hpp.write('namespace ' + self.namespace + ' {\n')
-    self.hpp.writelines(self.hppbody)
+      yield 'namespace ' + self.namespace + ' {\n'
+    yield from self.hppbody
+    yield from self.hppextern
     if self.namespace != None:
-      self.hpp.write('}\n')
-    self.hpp.writelines(self.hppend)
-    self.cpp.write('#include "' + os.path.basename(self.path + '.hpp') + '"\n')
-    self.cpp.writelines(self.cppstart)
+      yield '}\n'
+    yield from self.hppend
+
+  def cpp_head(self):
+    yield '#include "' + os.path.basename(self.path + '.hpp') + '"\n'
+    yield from self.cppstart
     if self.namespace != None:
-      self.cpp.write('using namespace ' + self.namespace + ';\n')
-    self.cpp.writelines(self.cppbody)
-    self.cpp.writelines(self.cppend)
-    self.file.close()
-    self.hpp.close()
-    self.cpp.close()
-
-  def current(self):
-    if self.line >= len(self.lines):
-      return None
+      yield 'using namespace ' + self.namespace + ';\n'
+
+  def cpp_fragments(self):
+    yield from self.cpp_head()
+    yield from self.cppbody
+    yield from self.cppend
+
+  def render(self):
+    # Each output is emitted in a single writelines pass over its sections
+    hpp = io.StringIO()
+    hpp.writelines(self.hpp_fragments())
+    cpp = io.StringIO()
+    cpp.writelines(self.cpp_fragments())
+    return hpp.getvalue(), cpp.getvalue()
+
+  def render_split(self, split):
+    # Implementation file texts with the method definitions spread over
+    # several files: split is a number of files, or 'class' for one file per
+    # class. Every file starts like the implementation file (header include,
+    # cppstart, using namespace); cppbody blocks, cppend and anything else
+    # stay in the first one
+    if split == None:
+      cpp = io.StringIO()
+      cpp.writelines(self.cpp_fragments())
+      return [cpp.getvalue()]
+    units = self.cppbody.units()
+    if split == 'class':
+      keys = collections.OrderedDict()
+      for key, fragments in units:
+        if key != None:
+          keys.setdefault(key, len(keys))
+      shards = [[] for i in range(max(len(keys), 1))]
+      for key, fragments in units:
+        shards[keys.get(key, 0)].append(fragments)
     else:
-      return self.lines[self.line]
+      # Consecutive runs of methods of about the same size, so that methods
+      # of a class tend to stay together
+      shards = [[] for i in range(max(split, 1))]
+      total = sum(len(f) for key, fragments in units for f in fragments)
+      offset = 0
+      for key, fragments in units:
+        k = 0 if key == None or total == 0 else min(len(shards) - 1, offset * len(shards) // total)
+        shards[k].append(fragments)
+        offset += sum(len(f) for f in fragments)
+    texts = []
+    for i, shard in enumerate(shards):
+      cpp = io.StringIO()
+      cpp.writelines(self.cpp_head())
+      if i == 0:
+        cpp.writelines(self.cppbody.blocks())
+      for fragments in shard:
+        cpp.writelines(fragments)
+      if i == 0:
+        cpp.writelines(self.cppend)
+      texts.append(cpp.getvalue())
+    return texts
+
+  def render_fwd(self):
+    # Forward declarations of the top-level classes, for dependents that only
+    # need pointers or references
+    fwd = io.StringIO()
+    fwd.write('#pragma once\n')
+    if self.namespace != None:
+      fwd.write('namespace ' + self.namespace + ' {\n')
+    fwd.writelines(keyword + ' ' + name + ';\n' for keyword, name in self.forward)
+    if self.namespace != None:
+      fwd.write('}\n')
+    return fwd.getvalue()
+
+  def close(self):
+    # Outputs are only built once the whole input has been processed, and
+    # files whose content did not change are left untouched
+    hpp, cpp = self.render()
+    write_if_changed(self.hpppath, hpp)
+    write_if_changed(self.cpppath, cpp)
+    return hpp, cpp
 
   def next(self):
-    if self.line >= len(self.lines):
-      return None
-    else:
-      l = self.lines[self.line]
-      self.line += 1
-      return l
+    return self.reader.next()
 
   def peek_next(self):
-    if self.line >= len(self.lines):
-      return None
-    else:
-      return self.lines[self.line]
-  
-  def insert(self, data):
-    self.lines.insert(self.line+1, data)
+    return self.reader.peek_next()
+
+  def resume(self, idx):
+    self.reader.resume(idx)
 
   def process(self):
-    line = self.next()
-    while line != None:
-      line = line.strip()
-      self.process_line(line)
+    try:
       line = self.next()
-    if len(SYM_STACK) != 0:
-      raise RuntimeError("Non-empty stack: " + str(SYM_STACK))
+      while line != None:
+        line = line.strip()
+        self.process_line(line)
+        line = self.next()
+    finally:
+      self.reader.close()
+    if len(self.sym_stack) != 0:
+      raise RuntimeError("Non-empty stack: " + str(self.sym_stack))
+    if self.region != None:
+      raise RuntimeError('Unterminated comment or raw string, expected ' + self.region)
+
+  def brackets(self, line, idx=0):
+    # Iterates over the matches of the brackets in line from idx on that are
+    # not inside a comment or a string or character literal. Most lines have
+    # none of these, so they are left to BRACKETS
+    if self.region == None and '/' not in line and '"' not in line and "'" not in line:
+      return BRACKETS.finditer(line, idx)
+    return self.lex(line, idx)
+
+  def lex(self, line, idx):
+    # Comments and literals are matched as a whole by TOKENS. Only block
+    # comments and raw strings can span lines; when the line ends inside one,
+    # self.region keeps what ends it for the next line
+    if self.region != None:
+      end = line.find(self.region, idx)
+      if end == -1:
+        return
+      idx = end + len(self.region)
+      self.region = None
+    for m in TOKENS.finditer(line, idx):
+      group = m.lastindex
+      if group == 1:
+        yield m
+      elif group == 2:
+        self.region = '*/'
+      elif group == 4:
+        self.region = ')' + m.group(3) + '"'
 
   def handle_char(self, c):
+    codes = self.sym_stack.codes
     if c == '{':
-      SYM_STACK.append('}')
+      codes.append(BRACE)
     elif c == '(':
-      SYM_STACK.append(')')
+      codes.append(PAREN)
     elif c == '[':
-      SYM_STACK.append(']')
+      codes.append(BRACKET)
     elif c == '}':
-      if SYM_STACK[len(SYM_STACK)-1] != '}':
-        raise RuntimeError('Want } following a class, but got ' + str(SYM_STACK[len(SYM_STACK)-1]))  
-      SYM_STACK.pop()
-      if len(SYM_STACK) >= 1 and type(SYM_STACK[len(SYM_STACK)-1]) is CMacsClassPragma:
-        SYM_STACK.pop()
+      if codes[-1] != BRACE:
+        raise RuntimeError('Want } following a class, but got ' + str(self.sym_stack.top()))
+      codes.pop()
+      if len(codes) >= 1 and codes[-1] == FRAME and type(self.sym_stack.frames[-1]) is CMacsClassPragma:
+        self.sym_stack.pop()
     elif c == ')' or c == ']':
-      if SYM_STACK[len(SYM_STACK)-1] != c:
-        raise RuntimeError('Expected ' + SYM_STACK[len(SYM_STACK)-1] + ', got ' + c)
+      if codes[-1] != CODES[c]:
+        raise RuntimeError('Expected ' + str(self.sym_stack.top()) + ', got ' + c)
       else:
-        SYM_STACK.pop() 
+        codes.pop()
+
+  def emit(self, record):
+    # Pragmas describe what they read as records of an intermediate
+    # representation (plain JSON data: dicts, lists, strings), which are kept
+    # in self.ir and applied to the output sections by the emitters. An IR
+    # can be replayed into a fresh file, e.g. one with other output options,
+    # without reading the input again
+    self.ir.append(record)
+    emitters[record['kind']](self, record)
+
+  def replay(self, ir):
+    for record in ir:
+      self.emit(record)
 
   def process_line(self, line):
     pragma = '#pragma cmacs'
-    if line.startswith(pragma):
+    if line.startswith(pragma) and self.region == None:
       self.process_pragma(line[len(pragma):len(line)].strip())
     elif len(line) > 0:
-      for c in line:
-        self.handle_char(c)
+      for m in self.brackets(line):
+        self.handle_char(m.group())
       self.hppbody.append(line + '\n')
+      # Runs of plain lines share one record
+      if len(self.ir) != 0 and self.ir[-1]['kind'] == 'text':
+        self.ir[-1]['lines'].append(line + '\n')
+      else:
+        self.ir.append({'kind': 'text', 'lines': [line + '\n']})
 
   def process_pragma(self, pragma):
     args = shlex.split(pragma, True, True)
@@ -593,39 +1570,1069 @@ class CMacsFile:
     args = args[1:len(args)]
     self.process_args(p, args)
 
+  def add_includes(self, block):
+    # Remembers the #include directives of the start blocks as (kind, name)
+    # pairs, kind being '<' or '"'
+    for line in block:
+      m = INCLUDE.match(line)
+      if m != None:
+        self.includes.append((m.group(1), m.group(2)))
+
+  def handle_char_tracked(self, c):
+    CMacsFile.handle_char(self, c)
+    if len(self.sym_stack) > self.max_depth:
+      self.max_depth = len(self.sym_stack)
+
   def process_args(self, pragma, args):
-    if pragma in pragmas:
+    if pragma in pragmas and self.stats != None:
+      chars = self.reader.chars
+      self.max_depth = len(self.sym_stack)
+      start = time.perf_counter()
+      pragmas[pragma](self, args).execute()
+      self.stats.add_pragma(pragma, time.perf_counter() - start, self.reader.chars - chars, self.max_depth)
+    elif pragma in pragmas:
       pragmas[pragma](self, args).execute()
     else:
-      print('invalid pragma: ' + pragma + ' ' + str(args))
-
-  def format(self):
-    if os.system('clang-format ' + self.cpppath + ' -i') != 0:
-      raise RuntimeError('Cannot format .cpp file')
-    if os.system('clang-format ' + self.hpppath + ' -i') != 0:
-      raise RuntimeError('Cannot format .hpp file')
+      print('invalid pragma: ' + pragma + ' ' + str(args), file=sys.stderr)
+
+
+class CMacsCache:
+  # Content-addressed store of final outputs. Every entry is a small JSON
+  # file named after the hash of everything that can change its content, and
+  # its mtime doubles as the last-use time for eviction. Long-running
+  # processes can keep recently used entries in memory as well (or only
+  # there, with dir=None)
+  def __init__(self, dir, memory=0):
+    self.dir = dir
+    self.memory = collections.OrderedDict() if memory > 0 else None
+    self.memory_size = memory
+    self.lock = threading.Lock()
+
+  def key(self, *parts):
+    h = hashlib.sha256()
+    for part in (VERSION,) + parts:
+      if not isinstance(part, bytes):
+        part = str(part).encode()
+      h.update(str(len(part)).encode() + b':' + part)
+    return h.hexdigest()
+
+  def entry(self, key):
+    return os.path.join(self.dir, key[0:2], key[2:len(key)] + '.json')
+
+  def remember(self, key, value):
+    with self.lock:
+      self.memory[key] = value
+      self.memory.move_to_end(key)
+      while len(self.memory) > self.memory_size:
+        self.memory.popitem(False)
+
+  def get(self, key):
+    if self.memory != None:
+      with self.lock:
+        value = self.memory.get(key)
+        if value != None:
+          self.memory.move_to_end(key)
+          return value
+    if self.dir == None:
+      return None
+    path = self.entry(key)
+    try:
+      with open(path, 'r') as f:
+        value = json.load(f)
+      os.utime(path)
+    except (OSError, ValueError):
+      return None
+    if self.memory != None:
+      self.remember(key, value)
+    return value
+
+  def put(self, key, value):
+    if self.memory != None:
+      self.remember(key, value)
+    if self.dir == None:
+      return
+    path = self.entry(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_if_changed(path, json.dumps(value, separators=(',', ':')))
+
+  def entries(self):
+    if self.dir == None or not os.path.isdir(self.dir):
+      return []
+    entries = []
+    for sub in os.scandir(self.dir):
+      if sub.is_dir():
+        for e in os.scandir(sub.path):
+          if e.name.endswith('.json'):
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+    return entries
+
+  def evict(self, max_size):
+    # Drops least recently used entries until the cache fits into max_size
+    entries = sorted(self.entries())
+    size = sum(e[1] for e in entries)
+    for mtime, esize, path in entries:
+      if size <= max_size:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      size -= esize
+
+  def clear(self):
+    if self.memory != None:
+      with self.lock:
+        self.memory.clear()
+    self.evict(0)
+
+
+def open_cache(options):
+  if not options.cache:
+    return None
+  return CMacsCache(options.cache_dir)
+
+
+def translate(text, namespace=None, name='cmacs.cm.cpp'):
+  # Translates source text in memory and returns the (hpp, cpp) pair. name is
+  # only used for the #include of the header in the implementation file;
+  # namespace applies when the text has no namespace pragma of its own
+  f = CMacsFile(name, False, text, namespace=namespace)
+  f.process()
+  return f.render()
 
-parser = argparse.ArgumentParser(description='C++ code preprocessor')
-parser.add_argument('file', metavar='FILE', type=str, help='input file')
-parser.add_argument('--format', action='store_true', help='format with clang-format')
-parser.add_argument('--here', action='store_true', help='put output in the working directory')
 
+def read_ir(text, name='cmacs.cm.cpp'):
+  # Parses source text into the intermediate representation (a list of
+  # records, see CMacsFile.emit) without producing outputs
+  f = CMacsFile(name, False, text)
+  f.process()
+  return f.ir
 
-args = parser.parse_args()
 
+def emit_ir(ir, namespace=None, name='cmacs.cm.cpp'):
+  # Produces the (hpp, cpp) pair from an intermediate representation
+  f = CMacsFile(name, False, '', namespace=namespace)
+  f.replay(ir)
+  return f.render()
 
-if not os.path.exists(args.file) and not os.path.isfile(args.file):
-  raise RuntimeError("Invalid file")
 
-try:
-  f = CMacsFile(args.file, args.here)
+def translate_file(path, namespace=None, here=False, write=False):
+  # Same as translate() for a file on disk; with write=True the outputs are
+  # also stored next to it (or in the working directory with here=True)
+  f = CMacsFile(path, here, namespace=namespace)
   f.process()
-  f.close()
-except Exception as e:
-  print(CLASS_STACK)
-  print(SYM_STACK)
-  f.close()
-  raise e
-
-if args.format:
-  f.format()
+  if write:
+    return f.close()
+  return f.render()
+
+
+def translation_key(cache, path, data, options):
+  # Formatted outputs also depend on which clang-format produced them and on
+  # the style file it reads for the output directory
+  identity = None
+  if options.format:
+    dir = os.path.dirname(os.path.abspath(output_paths(path, options.here)[0]))
+    identity = (clang_format_identity(options.clang_format), clang_format_style(dir))
+  return cache.key('translate', os.path.abspath(path), options.here, options.format, identity, options.namespace, options.split, data)
+
+
+def depfile_path(path, options):
+  if options.depfile != None:
+    return options.depfile
+  if options.MD:
+    return output_paths(path, options.here)[0][0:-len('.hpp')] + '.d'
+  return None
+
+
+def make_escape(path):
+  return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+def write_depfile(path, options, outputs, includes):
+  # Make/ninja depfile: the outputs depend on the input and on every other
+  # generated header (*.cm.cpp.hpp) the start blocks include, resolved the
+  # way the compiler resolves quoted includes from the generated files
+  dpath = depfile_path(path, options)
+  if dpath == None:
+    return
+  deps = [path]
+  dir = os.path.dirname(outputs[0])
+  for kind, name in includes:
+    if kind == '"' and name.endswith('.cm.cpp.hpp'):
+      dep = os.path.normpath(os.path.join(dir, name))
+      if dep not in deps:
+        deps.append(dep)
+  write_if_changed(dpath, ' '.join(make_escape(o) for o in outputs) + ': ' + ' '.join(make_escape(d) for d in deps) + '\n')
+
+
+def lookup_file(path, options, cache):
+  # Returns the cache entry for the current content of path, or None
+  try:
+    with open(path, 'rb') as file:
+      data = file.read()
+  except OSError:
+    return None
+  value = cache.get(translation_key(cache, path, data, options))
+  if value == None or 'includes' not in value or 'main' not in value or 'decls' not in value:
+    return None
+  if options.fwd and 'fwd' not in value:
+    return None
+  return value
+
+
+def write_restored(path, options, value, pch=None, writer=None):
+  if writer == None:
+    writer = CMacsWriter()
+  hpppath, cpppath = output_paths(path, options.here)
+  cpps = [value['cpp']] + value.get('shards', [])
+  outputs = [(hpppath, apply_pch(value['hpp'], hpppath, pch))]
+  outputs += [(shard_path(cpppath, i), cpp) for i, cpp in enumerate(cpps)]
+  write_outputs(outputs, writer)
+  if options.fwd:
+    writer.write(fwd_path(path, options.here), value['fwd'])
+  if not writer.check:
+    write_depfile(path, options, [o for o, text in outputs], value['includes'])
+
+
+def restore_file(path, options, cache, pch=None):
+  # Serves a file straight from the cache, skipping parsing and formatting
+  # altogether; returns the cache entry, or None on a cache miss
+  value = lookup_file(path, options, cache)
+  if value != None:
+    write_restored(path, options, value, pch)
+  return value
+
+
+def process_file(path, options, cache=None, data=None):
+  # Runs the pipeline for a single input and returns a result with an error
+  # report (or None), so that one broken file does not abort the rest of a
+  # batch. With --format, --pch, --check or redirected outputs they are
+  # handed back for commit_outputs() instead of being written here. data is
+  # the content of path when it does not come from the file itself (stdin)
+  result = {'path': path, 'error': None, 'key': None, 'outputs': None, 'includes': None, 'main': False, 'decls': 0, 'fwd': None, 'stats': None}
+  if data == None and not os.path.isfile(path):
+    result['error'] = path + ': invalid file'
+    return result
+  f = None
+  stats = None
+  if options.stats or options.stats_json != None:
+    stats = result['stats'] = CMacsStats()
+    stats.files = 1
+  try:
+    if cache == None:
+      cache = open_cache(options)
+    value = None
+    if cache != None:
+      if data == None:
+        with open(path, 'rb') as file:
+          data = file.read()
+      result['key'] = translation_key(cache, path, data, options)
+      # The IR only depends on the input text, so it survives changes of
+      # output options that invalidate the translation itself
+      irkey = cache.key('ir', data)
+      value = cache.get(irkey)
+      f = CMacsFile(path, options.here, data if value == None else '', stats=stats, namespace=options.namespace)
+    else:
+      f = CMacsFile(path, options.here, data, mmap=options.mmap, stats=stats, namespace=options.namespace)
+    start = time.perf_counter()
+    if value != None:
+      f.replay(value['ir'])
+    else:
+      f.process()
+      if cache != None and not options.check:
+        cache.put(irkey, {'ir': f.ir})
+    if stats != None:
+      stats.stages['process'] += time.perf_counter() - start
+    start = time.perf_counter()
+    hpp = ''.join(f.hpp_fragments())
+    cpps = f.render_split(options.split)
+    result['outputs'] = [(f.hpppath, hpp)] + [(shard_path(f.cpppath, i), cpp) for i, cpp in enumerate(cpps)]
+    if not defers_writes(options):
+      write_outputs(result['outputs'])
+    if stats != None:
+      stats.stages['close'] += time.perf_counter() - start
+    result['includes'] = f.includes
+    result['main'] = f.has_main
+    result['decls'] = count_declarations(f.ir)
+    result['fwd'] = f.render_fwd()
+    if defers_writes(options):
+      return result
+    if options.fwd:
+      write_if_changed(fwd_path(path, options.here), result['fwd'])
+    write_depfile(path, options, [o for o, text in result['outputs']], f.includes)
+    if cache != None:
+      cache.put(result['key'], {'hpp': hpp, 'cpp': cpps[0], 'shards': cpps[1:len(cpps)], 'includes': f.includes, 'main': f.has_main, 'decls': result['decls'], 'fwd': result['fwd']})
+  except Exception as e:
+    report = path + ': ' + type(e).__name__ + ': ' + str(e)
+    if f != None:
+      report = path + ':' + str(f.reader.lineno) + ': ' + type(e).__name__ + ': ' + str(e)
+    if f != None and len(f.sym_stack) != 0:
+      report += '\n  class stack: ' + str(f.class_stack)
+      report += '\n  symbol stack: ' + str(f.sym_stack)
+    result['error'] = report
+  return result
+
+
+def commit_outputs(results, options, cache, jobs, stats=None, pch=None, writer=None):
+  # Formats the outputs of every successfully translated file in one go (with
+  # --format), points the headers at the shared header (with --pch) and
+  # writes the ones that changed, or only compares them (with --check).
+  # Cache entries keep the headers as they were before the shared header was
+  # applied, as that depends on the whole batch
+  if writer == None:
+    writer = CMacsWriter()
+  pending = [r for r in results if r['error'] == None and r['outputs'] != None]
+  if options.format:
+    start = time.perf_counter()
+    formatted = iter(format_outputs([o for r in pending for o in r['outputs']], options, cache, jobs))
+    if stats != None:
+      stats.stages['format'] += time.perf_counter() - start
+  else:
+    formatted = iter([(data, None) for r in pending for path, data in r['outputs']])
+  for r in pending:
+    texts = [next(formatted) for o in r['outputs']]
+    errors = [error for text, error in texts if error != None]
+    if len(errors) != 0:
+      r['error'] = r['path'] + ': ' + errors[0]
+      continue
+    try:
+      hpppath = r['outputs'][0][0]
+      outputs = [(hpppath, apply_pch(texts[0][0], hpppath, pch))]
+      outputs += [(path, text) for (path, raw), (text, error) in zip(r['outputs'][1:len(r['outputs'])], texts[1:len(texts)])]
+      write_outputs(outputs, writer)
+      if options.fwd:
+        writer.write(fwd_path(r['path'], options.here), r['fwd'])
+      if writer.check:
+        continue
+      write_depfile(r['path'], options, [path for path, raw in r['outputs']], r['includes'])
+    except OSError as e:
+      r['error'] = r['path'] + ': ' + type(e).__name__ + ': ' + str(e)
+      continue
+    if cache != None:
+      cache.put(r['key'], {'hpp': texts[0][0], 'cpp': texts[1][0], 'shards': [text for text, error in texts[2:len(texts)]], 'includes': r['includes'], 'main': r['main'], 'decls': r['decls'], 'fwd': r['fwd']})
+
+
+def regenerate_file(path, options, cache):
+  # Whole pipeline for one file inside a long-running process; returns
+  # (served from cache, error report or None). With --pch the header is
+  # pointed at the shared header as it was written by the last batch run
+  pch = None
+  if options.pch != None:
+    pch = load_pch(options.pch)
+  if restore_file(path, options, cache, pch) != None:
+    return True, None
+  result = process_file(path, options, cache)
+  if defers_writes(options) and result['error'] == None:
+    commit_outputs([result], options, cache, 1, pch=pch)
+  return False, result['error']
+
+
+SERVE_MEMORY = 4096
+
+def returned_outputs(outputs, options, cache):
+  # Response for requests that get the outputs back instead of having them
+  # written, formatted like written ones would be
+  if options.format:
+    (hpp, error), (cpp, cpperror) = format_outputs(outputs, options, cache)
+    if error != None or cpperror != None:
+      return {'ok': False, 'error': error or cpperror}
+  else:
+    hpp, cpp = [text for path, text in outputs]
+  return {'ok': True, 'hpp': hpp, 'cpp': cpp}
+
+
+def serve_request(request, defaults, cache):
+  options = argparse.Namespace(**vars(defaults))
+  for name in ('here', 'format', 'namespace'):
+    if name in request:
+      setattr(options, name, request[name])
+  if options.here and 'cwd' in request:
+    options.here = request['cwd']
+  if 'text' in request:
+    name = request.get('name', 'cmacs.cm.cpp')
+    hpp, cpp = translate(request['text'], options.namespace, name)
+    return returned_outputs([(name + '.hpp', hpp), (name + '.cpp', cpp)], options, cache)
+  path = request['path']
+  if not request.get('write', True):
+    hpp, cpp = translate_file(path, options.namespace)
+    return returned_outputs(list(zip(output_paths(path, options.here), (hpp, cpp))), options, cache)
+  cached, error = regenerate_file(path, options, cache)
+  if error != None:
+    return {'ok': False, 'error': error}
+  return {'ok': True, 'cached': cached}
+
+
+def serve(options, socket_path=None):
+  # Long-running worker for build systems. Requests and responses are single
+  # JSON lines:
+  #   {"id": 1, "path": "a.cm.cpp"}              translate a file and write its outputs
+  #   {"id": 2, "path": "a.cm.cpp", "write": false}   return the outputs instead
+  #   {"id": 3, "text": "...", "name": "a.cm.cpp"}    translate source text
+  #   {"shutdown": true}                         stop the server
+  # "here", "cwd", "format" and "namespace" override the server's options.
+  # Responses carry "ok" plus either the outputs or an "error", and echo "id"
+  import socketserver
+  cache = CMacsCache(options.cache_dir if options.cache else None, memory=SERVE_MEMORY)
+  stop = threading.Event()
+
+  def handle(line):
+    try:
+      request = json.loads(line)
+    except ValueError as e:
+      return {'ok': False, 'error': 'invalid request: ' + str(e)}
+    if request.get('shutdown'):
+      stop.set()
+      response = {'ok': True}
+    else:
+      try:
+        response = serve_request(request, options, cache)
+      except Exception as e:
+        response = {'ok': False, 'error': type(e).__name__ + ': ' + str(e)}
+    if 'id' in request:
+      response['id'] = request['id']
+    return response
+
+  if socket_path == None:
+    for line in sys.stdin:
+      if line.strip() == '':
+        continue
+      sys.stdout.write(json.dumps(handle(line)) + '\n')
+      sys.stdout.flush()
+      if stop.is_set():
+        break
+    return
+
+  class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+      for line in self.rfile:
+        if line.strip() == b'':
+          continue
+        self.wfile.write((json.dumps(handle(line.decode())) + '\n').encode())
+        self.wfile.flush()
+        if stop.is_set():
+          threading.Thread(target=self.server.shutdown).start()
+          break
+
+  if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+    os.unlink(socket_path)
+  server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+  server.daemon_threads = True
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.unlink(socket_path)
+
+
+class CMacsInotify:
+  # Minimal inotify binding through ctypes. Watches whole directory trees
+  # and reports *.cm.cpp files that were written or moved into place
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_IGNORED = 0x00008000
+  IN_ISDIR = 0x40000000
+
+  def __init__(self, dirs):
+    import ctypes
+    import ctypes.util
+    import struct
+    self.event = struct.Struct('iIII')
+    # Wall-clock times of the last read and of the one before it
+    self.checked = self.since = time.time()
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.wds = {}
+    for dir in dirs:
+      self.add_tree(dir)
+
+  def add_tree(self, top):
+    import ctypes
+    mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+    for root, dirs, files in os.walk(top):
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), mask)
+      if wd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for ' + root)
+      self.wds[wd] = root
+
+  def poll(self, timeout):
+    import select
+    if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+      return []
+    # Events queue up while the previous batch is being processed
+    self.since = self.checked
+    data = os.read(self.fd, 1 << 16)
+    self.checked = time.time()
+    changed = []
+    idx = 0
+    while idx < len(data):
+      wd, mask, cookie, length = self.event.unpack_from(data, idx)
+      name = os.fsdecode(data[idx+self.event.size:idx+self.event.size+length].rstrip(b'\0'))
+      idx += self.event.size + length
+      dir = self.wds.get(wd)
+      if dir == None:
+        continue
+      if mask & self.IN_IGNORED:
+        del self.wds[wd]
+      elif mask & self.IN_ISDIR:
+        # Files may have landed in a new directory before it was watched
+        self.add_tree(os.path.join(dir, name))
+        changed += expand_inputs([os.path.join(dir, name)])
+      elif name.endswith('.cm.cpp') and mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+        changed.append(os.path.join(dir, name))
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+
+class CMacsPoller:
+  # Fallback for systems without inotify: rescans the trees and compares
+  # (mtime, size) of every input
+  def __init__(self, dirs, interval=0.5):
+    self.dirs = dirs
+    self.interval = interval
+    # Wall-clock times of the last scan and of the one before it
+    self.checked = self.since = time.time()
+    self.state = self.scan()
+
+  def scan(self):
+    state = {}
+    for path in expand_inputs(self.dirs):
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      state[path] = (st.st_mtime_ns, st.st_size)
+    return state
+
+  def poll(self, timeout):
+    time.sleep(self.interval if timeout == None else timeout)
+    self.since = self.checked
+    self.checked = time.time()
+    state = self.scan()
+    changed = [p for p, s in state.items() if self.state.get(p) != s]
+    self.state = state
+    return changed
+
+  def close(self):
+    pass
+
+
+def changed_at(path, watcher):
+  # Wall-clock time of the last write to path, so that the reported latency
+  # includes the time the watcher took to notice (up to a whole interval
+  # with --poll). Files moved in keep an older mtime, but cannot have changed
+  # before the watcher last looked
+  try:
+    return max(os.stat(path).st_mtime, watcher.since)
+  except OSError:
+    return watcher.checked
+
+
+def watch(dirs, options):
+  # Regenerates inputs under dirs as they change, in this process so that the
+  # pipeline stays warm. Bursts of events (editors often write a file more
+  # than once per save) are collected until nothing happened for
+  # options.debounce milliseconds
+  cache = CMacsCache(options.cache_dir if options.cache else None, memory=SERVE_MEMORY)
+  watcher = None
+  if not options.poll:
+    try:
+      watcher = CMacsInotify(dirs)
+    except (OSError, AttributeError) as e:
+      print('inotify not available (' + str(e) + '), polling instead', file=sys.stderr)
+  if watcher == None:
+    watcher = CMacsPoller(dirs)
+
+  for path in expand_inputs(dirs):
+    cached, error = regenerate_file(path, options, cache)
+    if error != None:
+      print(error, file=sys.stderr)
+  print('watching ' + ', '.join(dirs), file=sys.stderr)
+
+  try:
+    while True:
+      changed = watcher.poll(None)
+      if len(changed) == 0:
+        continue
+      seen = dict((path, changed_at(path, watcher)) for path in changed)
+      while True:
+        changed = watcher.poll(options.debounce / 1000)
+        if len(changed) == 0:
+          break
+        for path in changed:
+          if path not in seen:
+            seen[path] = changed_at(path, watcher)
+      for path, since in seen.items():
+        if not os.path.isfile(path):
+          continue
+        start = time.perf_counter()
+        cached, error = regenerate_file(path, options, cache)
+        done = time.perf_counter()
+        if error != None:
+          print(error, file=sys.stderr)
+        else:
+          print(path + ': ' + '%.1f ms' % ((done - start) * 1000) + ' (' + '%.1f ms' % (max(time.time() - since, 0) * 1000) + ' after the change)', file=sys.stderr)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watcher.close()
+
+
+PCH_NAME = 'cmacs_pch.hpp'
+
+def header_includes(text):
+  # <...> includes at the top of a generated header (right after #pragma
+  # once, i.e. from the hppstart blocks); only those can be moved into the
+  # shared header. Any other directive (#define, #undef, #pragma, quoted
+  # includes, conditionals) may change what the includes after it mean, so
+  # scanning stops there. Returns (name, line index) pairs
+  found = []
+  for i, line in enumerate(text.split('\n')):
+    line = line.strip()
+    if line == '' or line.startswith('//') or (i == 0 and line == '#pragma once'):
+      continue
+    m = INCLUDE.match(line)
+    if m == None or m.group(1) != '<':
+      break
+    found.append((m.group(2), i))
+  return found
+
+
+def common_includes(headers, min_count):
+  # Includes shared by at least min_count of the headers, in order of first
+  # appearance
+  counts = collections.OrderedDict()
+  for text in headers:
+    for name in set(name for name, i in header_includes(text)):
+      counts[name] = counts.get(name, 0) + 1
+  first = collections.OrderedDict()
+  for text in headers:
+    for name, i in header_includes(text):
+      if counts[name] >= min_count:
+        first[name] = True
+  return list(first)
+
+
+def write_pch(dir, names, writer=None):
+  if writer == None:
+    writer = CMacsWriter()
+  path = os.path.join(dir, PCH_NAME)
+  if not writer.check:
+    os.makedirs(dir, exist_ok=True)
+  writer.write(path, '#pragma once\n' + ''.join('#include <' + name + '>\n' for name in names))
+  return (path, set(names))
+
+
+def load_pch(dir):
+  path = os.path.join(dir, PCH_NAME)
+  try:
+    with open(path, 'r') as f:
+      return (path, set(name for name, i in header_includes(f.read())))
+  except OSError:
+    return None
+
+
+def apply_pch(text, hpppath, pch):
+  # Drops the includes the shared header provides from a generated header
+  # and includes the shared header in their place, right after #pragma once
+  if pch == None:
+    return text
+  path, names = pch
+  drop = set(i for name, i in header_includes(text) if name in names)
+  if len(drop) == 0:
+    return text
+  lines = text.split('\n')
+  rel = os.path.relpath(path, os.path.dirname(os.path.abspath(hpppath))).replace(os.sep, '/')
+  out = []
+  for i, line in enumerate(lines):
+    if i in drop:
+      continue
+    out.append(line)
+    if line.strip() == '#pragma once':
+      out.append('#include "' + rel + '"')
+  return '\n'.join(out)
+
+
+UNITY_SIZE = '512K'
+
+def unity_groups(entries, size=None, buckets=None):
+  # Splits (cpppath, size, input) entries into unity translation units,
+  # either greedily in input order up to size bytes per unit, or into a fixed
+  # number of buckets balanced by size. Units keep the input order of their
+  # files. Shards of one input (--split) repeat its cppstart blocks, so they
+  # always end up in different units; with buckets, an input with more shards
+  # than there are buckets gets extra ones
+  if buckets != None:
+    groups = [[] for i in range(min(buckets, len(entries)))]
+    totals = [0] * len(groups)
+    owners = [set() for g in groups]
+    for i, (path, n, input) in sorted(enumerate(entries), key=lambda e: -e[1][1]):
+      free = [k for k in range(len(groups)) if input not in owners[k]]
+      if len(free) == 0:
+        groups.append([])
+        totals.append(0)
+        owners.append(set())
+        free = [len(groups) - 1]
+      k = min(free, key=lambda k: totals[k])
+      groups[k].append(i)
+      totals[k] += n
+      owners[k].add(input)
+    return [[entries[i][0] for i in sorted(g)] for g in groups]
+  groups = []
+  total = 0
+  owners = set()
+  for path, n, input in entries:
+    if len(groups) == 0 or (total + n > size and len(groups[-1]) != 0) or input in owners:
+      groups.append([])
+      total = 0
+      owners = set()
+    groups[-1].append(path)
+    total += n
+    owners.add(input)
+  return groups
+
+
+def write_unity(dir, groups):
+  # Writes unity_N.cpp files including the generated implementations and
+  # removes units left over from a previous run with more of them
+  os.makedirs(dir, exist_ok=True)
+  for i, group in enumerate(groups):
+    lines = ['#include "' + os.path.relpath(path, dir).replace(os.sep, '/') + '"\n' for path in group]
+    write_if_changed(os.path.join(dir, 'unity_' + str(i) + '.cpp'), ''.join(lines))
+  i = len(groups)
+  while os.path.exists(os.path.join(dir, 'unity_' + str(i) + '.cpp')):
+    os.remove(os.path.join(dir, 'unity_' + str(i) + '.cpp'))
+    i += 1
+
+
+# IR records that put a declaration into the generated header
+DECLARATIONS = ('class', 'method', 'main', 'constructor', 'destructor')
+
+def count_declarations(ir):
+  return sum(1 for record in ir if record['kind'] in DECLARATIONS)
+
+
+def syntax_time(cxx, path):
+  # Seconds a syntax-only compile of path takes, or None if it fails
+  import subprocess
+  start = time.perf_counter()
+  try:
+    p = subprocess.run(cxx + ['-fsyntax-only', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  except OSError:
+    return None
+  if p.returncode != 0:
+    return None
+  return time.perf_counter() - start
+
+
+def cost_report(files, here, cxx=None, jobs=1):
+  # Estimates what the generated headers of a batch cost the C++ build.
+  # files are (path, start block includes, declaration count, implementation
+  # file count) tuples. The fan-in of a header is the number of other inputs
+  # whose start blocks include it, and included_size is what the compiler
+  # reads of it over the batch. With cxx, every output is also compiled with
+  # -fsyntax-only; header_time is then the time of the header on its own
+  entries = []
+  owners = {}
+  for path, includes, decls, count in files:
+    hpppath, cpppath = output_paths(path, here)
+    with open(hpppath, 'r') as f:
+      text = f.read()
+    owners[os.path.normpath(hpppath)] = len(entries)
+    entries.append({
+      'path': path,
+      'header': hpppath,
+      'includes': len(INCLUDES.findall(text)),
+      'declarations': decls,
+      'size': len(text.encode()),
+      'fan_in': 0,
+      'outputs': [hpppath] + [shard_path(cpppath, i) for i in range(count)],
+    })
+  for i, (path, includes, decls, count) in enumerate(files):
+    dir = os.path.dirname(entries[i]['header'])
+    deps = set(os.path.normpath(os.path.join(dir, name)) for kind, name in includes if kind == '"')
+    for dep in deps:
+      if dep in owners and owners[dep] != i:
+        entries[owners[dep]]['fan_in'] += 1
+  for e in entries:
+    e['included_size'] = e['size'] * (1 + e['fan_in'])
+  if cxx == None:
+    return sorted(entries, key=lambda e: -e['included_size'])
+  outputs = [o for e in entries for o in e['outputs']]
+  import concurrent.futures
+  with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+    times = dict(zip(outputs, pool.map(syntax_time, itertools.repeat(cxx), outputs)))
+  for e in entries:
+    e['failed'] = [o for o in e['outputs'] if times[o] == None]
+    e['header_time'] = times[e['header']]
+    e['total_time'] = sum(times[o] or 0.0 for o in e['outputs'])
+  # A header is compiled again in every file that includes it
+  return sorted(entries, key=lambda e: (-(e['header_time'] or 0.0) * (1 + e['fan_in']), -e['included_size']))
+
+
+def print_report(entries, out):
+  timed = len(entries) != 0 and 'header_time' in entries[0]
+  out.write('%-40s %8s %8s %10s %7s %12s' % ('header', 'includes', 'decls', 'size', 'fan-in', 'included'))
+  out.write(' %10s %10s\n' % ('hpp time', 'total time') if timed else '\n')
+  for e in entries:
+    out.write('%-40s %8d %8d %10d %7d %12d' % (e['header'], e['includes'], e['declarations'], e['size'], e['fan_in'], e['included_size']))
+    if timed:
+      header_time = 'failed' if e['header_time'] == None else '%.4fs' % e['header_time']
+      out.write(' %10s %9.4fs' % (header_time, e['total_time']))
+    out.write('\n')
+  out.write('headers: ' + str(len(entries)))
+  for name, key in (('includes', 'includes'), ('declarations', 'declarations'), ('bytes', 'size'), ('bytes included', 'included_size')):
+    out.write(', ' + name + ': ' + str(sum(e[key] for e in entries)))
+  if timed:
+    out.write(', compile time: ' + '%.4fs' % sum(e['total_time'] for e in entries))
+    failed = sum(len(e['failed']) for e in entries)
+    if failed != 0:
+      out.write(' (' + str(failed) + ' outputs failed to compile)')
+  out.write('\n')
+
+
+def parse_size(value):
+  units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+  value = value.strip().upper()
+  if len(value) > 0 and value[len(value)-1] in units:
+    return int(float(value[0:len(value)-1]) * units[value[len(value)-1]])
+  return int(value)
+
+
+def parse_count(value):
+  # Type of options that count files, which need at least one
+  try:
+    n = int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError('expected a number, got ' + value)
+  if n < 1:
+    raise argparse.ArgumentTypeError('must be at least 1, got ' + value)
+  return n
+
+
+def expand_inputs(names):
+  # FILE arguments may be plain files, directories (searched recursively for
+  # *.cm.cpp) or glob patterns
+  paths = []
+  for name in names:
+    if os.path.isdir(name):
+      for root, dirs, files in os.walk(name):
+        dirs.sort()
+        for fname in sorted(files):
+          if fname.endswith('.cm.cpp'):
+            paths.append(os.path.join(root, fname))
+    elif any(c in name for c in '*?['):
+      paths += sorted(glob.glob(name, recursive=True))
+    else:
+      paths.append(name)
+  seen = set()
+  return [p for p in paths if not (p in seen or seen.add(p))]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='C++ code preprocessor')
+  parser.add_argument('files', metavar='FILE', type=str, nargs='*', help='input files, directories or glob patterns; - reads a single input from stdin')
+  parser.add_argument('--stdin-name', metavar='NAME', default='stdin.cm.cpp', help='path the input read from stdin is treated as, for output names and includes (default: stdin.cm.cpp)')
+  parser.add_argument('--stdout', action='store_true', help='write all outputs to stdout, each one preceded by a "#cmacs SIZE PATH" line, instead of to disk')
+  parser.add_argument('--hpp-out', metavar='TARGET', default=None, help='write the header of the single input to TARGET instead: a path, - for stdout or fd:N')
+  parser.add_argument('--cpp-out', metavar='TARGET', default=None, help='write the implementation of the single input to TARGET instead: a path, - for stdout or fd:N')
+  parser.add_argument('--format', action='store_true', help='format with clang-format')
+  parser.add_argument('--check', action='store_true', help='only compare the outputs with the files on disk, print a diff of the ones that are out of date and fail if there are any')
+  parser.add_argument('--clang-format', metavar='PATH', default='clang-format', help='clang-format executable used by --format')
+  parser.add_argument('--here', action='store_true', help='put output in the working directory')
+  parser.add_argument('--namespace', metavar='NS', default=None, help='namespace for inputs without a namespace pragma')
+  parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: CPU count)')
+  parser.add_argument('--mmap', action='store_true', help='read inputs through mmap instead of buffered reads')
+  parser.add_argument('--split', metavar='N', type=parse_count, default=None, help='spread the method definitions of each input over N implementation files (X.cm.cpp.cpp, X.cm.cpp.1.cpp, ...)')
+  parser.add_argument('--split-by', dest='split', choices=['class'], help='one implementation file per class instead')
+  parser.add_argument('--fwd', action='store_true', help='also write X.cm.cpp.fwd.hpp with forward declarations of the top-level classes')
+  parser.add_argument('-MD', dest='MD', action='store_true', help='write a make/ninja depfile next to each generated header')
+  parser.add_argument('-MF', dest='depfile', metavar='FILE', default=None, help='depfile path (single input only, implies -MD)')
+  parser.add_argument('--stats', action='store_true', help='print per-pragma timings and stage times to stderr')
+  parser.add_argument('--stats-json', metavar='FILE', default=None, help='write the same statistics as JSON to FILE (- for stdout)')
+  parser.add_argument('--report', action='store_true', help='print the compile cost of each generated header to stderr: includes, declarations, size and fan-in within the batch')
+  parser.add_argument('--report-json', metavar='FILE', default=None, help='write the same report as JSON to FILE (- for stdout)')
+  parser.add_argument('--report-cxx', metavar='CMD', default=None, help="also time 'CMD -fsyntax-only' on every output for the report, e.g. 'g++ -std=c++17 -Iinclude'")
+  parser.add_argument('--serve', action='store_true', help='run as a server answering JSON requests on stdin/stdout or --socket')
+  parser.add_argument('--socket', metavar='PATH', default=None, help='Unix socket for --serve')
+  parser.add_argument('--watch', metavar='DIR', action='append', default=None, help='regenerate *.cm.cpp files under DIR whenever they change (repeatable)')
+  parser.add_argument('--debounce', metavar='MS', type=float, default=100, help='quiet period that ends a burst of changes in --watch mode (default: 100)')
+  parser.add_argument('--poll', action='store_true', help='poll for changes instead of using inotify in --watch mode')
+  parser.add_argument('--pch', metavar='DIR', default=None, help='move <...> includes shared by several inputs into DIR/' + PCH_NAME + ' (for -include or precompiling) and include that instead')
+  parser.add_argument('--pch-min', metavar='N', type=int, default=2, help='number of inputs an include has to appear in to be shared (default: 2)')
+  parser.add_argument('--unity', metavar='DIR', default=None, help='also write unity_N.cpp files to DIR that include the generated implementations; files with a main pragma are left out')
+  parser.add_argument('--unity-size', metavar='SIZE', type=parse_size, default=parse_size(UNITY_SIZE), help='start a new unity file after SIZE bytes of included code (default: ' + UNITY_SIZE + ')')
+  parser.add_argument('--unity-buckets', metavar='N', type=parse_count, default=None, help='split into N unity files of similar size instead')
+  parser.add_argument('--cache', action='store_true', help='reuse outputs of unchanged inputs from the cache')
+  parser.add_argument('--cache-dir', metavar='DIR', default='.cmacs-cache', help='cache directory (default: .cmacs-cache)')
+  parser.add_argument('--cache-max-size', metavar='SIZE', type=parse_size, default=None, help='evict least recently used cache entries above SIZE bytes (K/M/G suffixes allowed)')
+  parser.add_argument('--cache-clear', action='store_true', help='remove all cache entries before processing')
+
+  args = parser.parse_args(argv)
+
+  if (args.check or redirects_outputs(args)) and (args.serve or args.watch != None):
+    parser.error('--check and redirected outputs cannot be combined with --serve or --watch')
+  report = args.report or args.report_json != None or args.report_cxx != None
+  if redirects_outputs(args) and (args.check or args.unity != None):
+    parser.error('--check and --unity need the outputs on disk')
+  if report and (redirects_outputs(args) or args.check):
+    parser.error('--report needs the outputs written to disk')
+  if args.stdout and (args.hpp_out != None or args.cpp_out != None):
+    parser.error('--stdout cannot be combined with --hpp-out or --cpp-out')
+  if args.cpp_out != None and args.split != None:
+    parser.error('--cpp-out cannot be combined with --split')
+  if args.stats_json == '-' and (args.stdout or args.hpp_out == '-' or args.cpp_out == '-'):
+    parser.error('--stats-json - cannot share stdout with the outputs')
+  if args.serve:
+    serve(args, args.socket)
+    return
+  if args.watch != None:
+    watch(args.watch, args)
+    return
+
+  cache = open_cache(args)
+  if cache != None and args.cache_clear:
+    cache.clear()
+
+  paths = expand_inputs(args.files)
+  if len(paths) == 0:
+    if cache != None and args.cache_clear:
+      return
+    parser.error('no input files')
+
+  if args.depfile != None and len(paths) != 1:
+    parser.error('-MF needs exactly one input file')
+  if (args.hpp_out != None or args.cpp_out != None) and len(paths) != 1:
+    parser.error('--hpp-out and --cpp-out need exactly one input file')
+
+  data = None
+  if '-' in paths:
+    if len(paths) != 1:
+      parser.error('- cannot be combined with other inputs')
+    # A depfile has to name an input make or ninja can check
+    if (args.MD or args.depfile != None) and not os.path.isfile(args.stdin_name):
+      parser.error('-MD and -MF with - need --stdin-name to name an existing file')
+    data = sys.stdin.buffer.read()
+    paths = [args.stdin_name]
+
+  targets = {}
+  if args.hpp_out != None:
+    targets[output_paths(paths[0], args.here)[0]] = open_target(args.hpp_out)
+  if args.cpp_out != None:
+    targets[output_paths(paths[0], args.here)[1]] = open_target(args.cpp_out)
+
+  inputs = paths
+  total = len(paths)
+  restored = {}
+  writer = CMacsWriter(args.check, sys.stdout.buffer if args.stdout else None, targets)
+  if cache != None and data == None:
+    # Whenever the outputs go through commit_outputs() (the shared header is
+    # not known yet, or they are compared or redirected instead of written),
+    # the restored ones go through the same writer later on
+    for path in paths:
+      if defers_writes(args):
+        value = lookup_file(path, args, cache)
+      else:
+        value = restore_file(path, args, cache)
+      if value != None:
+        restored[path] = value
+    paths = [p for p in paths if p not in restored]
+  stats = None
+  if args.stats or args.stats_json != None:
+    stats = CMacsStats()
+    stats.files = stats.cached = total - len(paths)
+  jobs = args.jobs or os.cpu_count() or 1
+  jobs = min(jobs, len(paths))
+
+  if data != None:
+    results = [process_file(paths[0], args, data=data)]
+  elif jobs <= 1:
+    results = [process_file(path, args) for path in paths]
+  else:
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+      results = list(pool.map(process_file, paths, itertools.repeat(args)))
+
+  pch = None
+  if args.pch != None:
+    headers = [value['hpp'] for value in restored.values()]
+    headers += [r['outputs'][0][1] for r in results if r['error'] == None]
+    pch = write_pch(args.pch, common_includes(headers, args.pch_min), writer)
+  if defers_writes(args):
+    for path, value in restored.items():
+      write_restored(path, args, value, pch, writer)
+    commit_outputs(results, args, cache, args.jobs or os.cpu_count() or 1, stats, pch, writer)
+  for stream in [writer.stream] + list(writer.targets.values()):
+    if stream != None:
+      stream.flush()
+
+  if stats != None:
+    for r in results:
+      if r['stats'] != None:
+        stats.merge(r['stats'])
+    if args.stats:
+      stats.report(sys.stderr)
+    if args.stats_json == '-':
+      print(json.dumps(stats.to_dict(), indent=2))
+    elif args.stats_json != None:
+      with open(args.stats_json, 'w') as f:
+        json.dump(stats.to_dict(), f, indent=2)
+
+  if cache != None and args.cache_max_size != None:
+    cache.evict(args.cache_max_size)
+
+  failed = [r['error'] for r in results if r['error'] != None]
+  mains = dict((path, value['main']) for path, value in restored.items())
+  mains.update((r['path'], r['main']) for r in results)
+  counts = dict((path, 1 + len(value.get('shards', []))) for path, value in restored.items())
+  counts.update((r['path'], len(r['outputs']) - 1) for r in results if r['error'] == None)
+  if args.unity != None and len(failed) == 0 and not args.check:
+    # Files with a main pragma are compiled on their own, so that a unit
+    # never ends up with more than one main (with --split only the first
+    # implementation file has it)
+    entries = []
+    for path in inputs:
+      cpppath = output_paths(path, args.here)[1]
+      for i in range(1 if mains[path] else 0, counts[path]):
+        entries.append((shard_path(cpppath, i), os.path.getsize(shard_path(cpppath, i)), path))
+    write_unity(args.unity, unity_groups(entries, args.unity_size, args.unity_buckets))
+
+  if report:
+    # Inputs that failed have no outputs to report on
+    files = [(path, value['includes'], value['decls'], counts[path]) for path, value in restored.items()]
+    files += [(r['path'], r['includes'], r['decls'], counts[r['path']]) for r in results if r['error'] == None]
+    order = dict((path, i) for i, path in enumerate(inputs))
+    files.sort(key=lambda f: order[f[0]])
+    cxx = shlex.split(args.report_cxx) if args.report_cxx != None else None
+    entries = cost_report(files, args.here, cxx, args.jobs or os.cpu_count() or 1)
+    if args.report or args.report_json == None:
+      print_report(entries, sys.stderr)
+    if args.report_json == '-':
+      print(json.dumps(entries, indent=2))
+    elif args.report_json != None:
+      with open(args.report_json, 'w') as f:
+        json.dump(entries, f, indent=2)
+
+  for report in failed:
+    print(report, file=sys.stderr)
+  for diff in writer.stale:
+    sys.stdout.write(diff)
+  if len(writer.stale) != 0:
+    print(str(len(writer.stale)) + ' generated files are out of date', file=sys.stderr)
+  if len(failed) != 0:
+    if total > 1:
+      print(str(len(failed)) + ' of ' + str(total) + ' files failed', file=sys.stderr)
+    sys.exit(1)
+  if len(writer.stale) != 0:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Nickolay Ilyushin
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Benchmarks for cmacs
+# Generates synthetic .cm.cpp inputs and times the pipeline stages separately:
+# - tokenize: pulling lines through the reader and scanning them for brackets
+# - process: CMacsFile.process(), i.e. tokenizing plus pragma execution
+# - emit: CMacsFile.render(), the in-memory part of close()
+#
+# Results can be stored with --save-baseline and compared against later runs
+# with --baseline, which fails when a stage got slower than the tolerance
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import cmacs
+
+
+def generate(classes=20, methods=50, constructors=2, depth=1, body_lines=10, blocks=20):
+  out = ['#pragma cmacs namespace Bench\n\n']
+  for b in range(blocks):
+    kind = ('includes', 'hpp', 'hppend', 'cppstart', 'cpp', 'cppend')[b % 6]
+    out.append('#pragma cmacs ' + kind + '\n{\n')
+    out.append('  // block ' + str(b) + '\n')
+    if kind == 'includes':
+      out.append('  #include <vector>\n')
+    if kind == 'hpp' or kind == 'cpp':
+      out.append('  struct Block' + str(b) + ' { int values[4] = {1, 2, 3, 4}; };\n')
+    out.append('}\n\n')
+  for c in range(classes):
+    generate_class(out, 'C' + str(c), methods, constructors, depth, body_lines)
+  return ''.join(out)
+
+
+def generate_class(out, name, methods, constructors, depth, body_lines, indent=''):
+  out.append(indent + '#pragma cmacs class\n')
+  out.append(indent + 'class ' + name + ' {\n')
+  out.append(indent + 'public:\n')
+  for k in range(constructors):
+    out.append(indent + '  #pragma cmacs constructor\n')
+    out.append(indent + '  ' + name + '(int a' + ', int b' * k + ')\n')
+    out.append(indent + '  : a_(a)\n')
+    out.append(indent + '  , b_(' + ('b' if k else '0') + ')\n')
+    out.append(indent + '  {\n')
+    out.append(indent + '    init(a_, b_);\n')
+    out.append(indent + '  }\n')
+  out.append(indent + '  #pragma cmacs destructor\n')
+  out.append(indent + '  virtual ~' + name + '() {\n')
+  out.append(indent + '    release(a_);\n')
+  out.append(indent + '  }\n')
+  for m in range(methods):
+    out.append(indent + '  #pragma cmacs method\n')
+    out.append(indent + '  ' + ('static ' if m % 7 == 0 else '') + 'int method_' + str(m) + '(int x, const std::vector<int>& v) {\n')
+    for l in range(body_lines):
+      out.append(indent + '    total += compute(x, v[' + str(l) + ']) * table[' + str(l) + '] + offset_' + str(l) + ';\n')
+    out.append(indent + '    log("method_' + str(m) + ': {%d}", x); // not counted: ( [\n')
+    out.append(indent + '    if (x > 0) { return total; }\n')
+    out.append(indent + '    return 0;\n')
+    out.append(indent + '  }\n')
+  if depth > 1:
+    generate_class(out, name + 'Inner', methods // 2, constructors, depth - 1, body_lines, indent + '  ')
+  out.append(indent + 'private:\n')
+  out.append(indent + '  int a_;\n')
+  out.append(indent + '  int b_;\n')
+  out.append(indent + '};\n\n')
+
+
+def best(fn, repeat):
+  times = []
+  for i in range(repeat):
+    t = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - t)
+  return min(times)
+
+
+def tokenize(text):
+  # The same bracket scan the readers do, skipping comments and literals
+  f = cmacs.CMacsFile('bench.cm.cpp', False, text)
+  count = 0
+  line = f.next()
+  while line != None:
+    for m in f.brackets(line):
+      count += 1
+    line = f.next()
+  return count
+
+
+def translate(data):
+  f = cmacs.CMacsFile('bench.cm.cpp', False, data)
+  f.process()
+  return f
+
+
+def run(text, repeat):
+  data = text.encode()
+  lines = text.count('\n')
+  results = {
+    'bytes': len(data),
+    'lines': lines,
+    'tokenize': best(lambda: tokenize(text), repeat),
+    'process': best(lambda: translate(data), repeat),
+  }
+  files = [translate(data) for i in range(repeat)]
+  results['emit'] = best(lambda: files.pop().render(), repeat)
+  results['lines_per_s'] = lines / results['process']
+  results['mb_per_s'] = len(data) / results['process'] / 1e6
+  tracemalloc.start()
+  translate(data).render()
+  results['peak_memory'] = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return results
+
+
+STAGES = ('tokenize', 'process', 'emit')
+
+def compare(results, baseline, tolerance):
+  regressions = []
+  for stage in STAGES:
+    if stage in baseline and results[stage] > baseline[stage] * (1 + tolerance):
+      regressions.append(stage + ': ' + '%.4fs' % results[stage] + ' vs baseline ' + '%.4fs' % baseline[stage])
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='cmacs benchmarks')
+  parser.add_argument('--classes', type=int, default=20, help='number of top-level classes')
+  parser.add_argument('--methods', type=int, default=50, help='methods per class')
+  parser.add_argument('--constructors', type=int, default=2, help='constructors per class')
+  parser.add_argument('--depth', type=int, default=1, help='class nesting depth')
+  parser.add_argument('--body-lines', type=int, default=10, help='lines per method body')
+  parser.add_argument('--blocks', type=int, default=20, help='number of hpp/cpp blocks')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best one is reported')
+  parser.add_argument('--write', metavar='FILE', help='also write the generated input to FILE')
+  parser.add_argument('--json', action='store_true', help='print results as JSON')
+  parser.add_argument('--save-baseline', metavar='FILE', help='store the results as a baseline')
+  parser.add_argument('--baseline', metavar='FILE', help='compare against a stored baseline')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline (default: 0.25)')
+  args = parser.parse_args()
+
+  text = generate(args.classes, args.methods, args.constructors, args.depth, args.body_lines, args.blocks)
+  if args.write:
+    with open(args.write, 'w') as f:
+      f.write(text)
+  results = run(text, max(args.repeat, 1))
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+  else:
+    print('input:     ' + str(results['lines']) + ' lines, ' + '%.2f MB' % (results['bytes'] / 1e6))
+    for stage in STAGES:
+      print('%-10s %.4fs' % (stage + ':', results[stage]))
+    print('speed:     ' + '%.0f lines/s, %.2f MB/s' % (results['lines_per_s'], results['mb_per_s']))
+    print('memory:    ' + '%.2f MB peak' % (results['peak_memory'] / 1e6))
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2)
+  if args.baseline:
+    with open(args.baseline, 'r') as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for r in regressions:
+      print('regression: ' + r, file=sys.stderr)
+    if len(regressions) != 0:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Nickolay Ilyushin
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Client shim for 'cmacs.py --serve --socket PATH'
+# Usage: cmacs_client.py [--socket PATH] [--here] [--format] [--namespace NS] FILE...
+# Forwards every FILE to the server, which translates it and writes the
+# outputs. The socket defaults to $CMACS_SOCKET. When no server is listening
+# the files are translated in-process instead, so build rules keep working
+# without one
+
+import json
+import os
+import socket
+import sys
+import threading
+
+
+def parse(argv):
+  # Options that are not given are left to the server's own settings
+  options = {'socket': os.environ.get('CMACS_SOCKET'), 'here': False, 'format': False, 'namespace': None}
+  files = []
+  forwarded = []
+  idx = 0
+  while idx < len(argv):
+    arg = argv[idx]
+    if (arg == '--socket' or arg == '--namespace') and idx + 1 == len(argv):
+      raise ValueError(arg + ' needs an argument')
+    if arg == '--socket':
+      idx += 1
+      options['socket'] = argv[idx]
+    elif arg == '--namespace':
+      idx += 1
+      options['namespace'] = argv[idx]
+      forwarded += [arg, argv[idx]]
+    elif arg == '--here' or arg == '--format':
+      options[arg[2:len(arg)]] = True
+      forwarded.append(arg)
+    elif arg.startswith('-'):
+      raise ValueError('unknown option ' + arg)
+    else:
+      files.append(arg)
+      forwarded.append(arg)
+    idx += 1
+  return options, files, forwarded
+
+
+def send(conn, requests):
+  # Runs next to the loop reading the responses: the server answers while
+  # requests are still coming in, so sending everything before reading
+  # would fill both socket buffers and block both sides
+  try:
+    for request in requests:
+      conn.sendall(request.encode())
+  except OSError:
+    pass
+
+
+def main(argv):
+  try:
+    options, files, forwarded = parse(argv)
+  except ValueError as e:
+    print('cmacs_client.py: error: ' + str(e), file=sys.stderr)
+    return 2
+  requests = []
+  for i, path in enumerate(files):
+    request = {'id': i, 'path': os.path.abspath(path)}
+    if options['format']:
+      request['format'] = True
+    if options['here']:
+      request['here'] = True
+      request['cwd'] = os.getcwd()
+    if options['namespace'] != None:
+      request['namespace'] = options['namespace']
+    requests.append(json.dumps(request) + '\n')
+
+  conn = None
+  if options['socket'] != None:
+    try:
+      conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      conn.connect(options['socket'])
+    except OSError:
+      conn.close()
+      conn = None
+  if conn == None:
+    import cmacs
+    cmacs.main(forwarded)
+    return 0
+
+  sender = threading.Thread(target=send, args=(conn, requests), daemon=True)
+  sender.start()
+  status = 0
+  with conn.makefile('r') as responses:
+    for i in range(len(files)):
+      line = responses.readline()
+      if line == '':
+        print('cmacs server closed the connection', file=sys.stderr)
+        return 1
+      response = json.loads(line)
+      if not response['ok']:
+        print(response['error'], file=sys.stderr)
+        status = 1
+  sender.join()
+  conn.close()
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+# Regression tests for cmacs, run with pytest
+
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+import cmacs
+
+
+SOURCE = '''#pragma cmacs includes
+{
+  #include <iostream>
+}
+
+#pragma cmacs namespace Example
+
+#pragma cmacs class
+class Main {
+public:
+  #pragma cmacs method
+  int get(int x) {
+    return x + 1;
+  }
+};
+'''
+
+# Stand-in for clang-format (-i, or stdin to stdout): drops indentation and
+# tags the text, so that formatted outputs can be told apart
+FAKE_CLANG_FORMAT = '''#!/usr/bin/env python3
+import sys
+fmt = lambda text: ''.join(l.strip() + '\\n' for l in text.splitlines() if l.strip()) + '// %s\\n'
+if '-i' not in sys.argv:
+  sys.stdout.write(fmt(sys.stdin.read()))
+for path in sys.argv[1:]:
+  if path.startswith('-'):
+    continue
+  with open(path) as f:
+    text = f.read()
+  with open(path, 'w') as f:
+    f.write(fmt(text))
+'''
+
+
+def write(path, text, mode=None):
+  with open(path, 'w') as f:
+    f.write(text)
+  if mode != None:
+    os.chmod(path, os.stat(path).st_mode | mode)
+  return str(path)
+
+
+def read(path):
+  with open(path) as f:
+    return f.read()
+
+
+def fake_clang_format(dir, tag='formatted'):
+  return write(os.path.join(dir, 'cf-' + tag), FAKE_CLANG_FORMAT % tag, stat.S_IXUSR)
+
+
+def test_check_format_cache_reports_stale_output(tmp_path, capsys):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  options = ['--format', '--clang-format', fake_clang_format(str(tmp_path)), '--cache', '--cache-dir', str(tmp_path / 'cache')]
+  cmacs.main([src] + options)
+  hpp = src + '.hpp'
+  stale = read(hpp) + '// stale\n'
+  write(hpp, stale)
+  with pytest.raises(SystemExit) as e:
+    cmacs.main([src, '--check'] + options)
+  assert e.value.code == 1
+  assert read(hpp) == stale
+  assert '-// stale' in capsys.readouterr().out
+
+
+def test_stdout_format_cache_hit_is_framed(tmp_path, capfdbinary):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  options = ['--format', '--clang-format', fake_clang_format(str(tmp_path)), '--cache', '--cache-dir', str(tmp_path / 'cache')]
+  cmacs.main([src] + options)
+  os.remove(src + '.hpp')
+  capfdbinary.readouterr()
+  cmacs.main([src, '--stdout'] + options)
+  out = capfdbinary.readouterr().out.decode()
+  assert out.startswith('#cmacs ')
+  assert '#cmacs ' + str(len(read(src + '.cpp').encode())) + ' ' + src + '.cpp\n' in out
+  assert not os.path.exists(src + '.hpp')
+
+
+def test_unity_keeps_shards_of_one_input_apart(tmp_path):
+  src = write(tmp_path / 's.cm.cpp', '''#pragma cmacs cppstart
+{
+  static int helper() { return 1; }
+}
+
+#pragma cmacs class
+class S {
+public:
+  #pragma cmacs method
+  int a() { return helper(); }
+
+  #pragma cmacs method
+  int b() { return helper() + 1; }
+};
+''')
+  cmacs.main([src, '--split', '2', '--unity', str(tmp_path / 'u')])
+  units = sorted(os.listdir(tmp_path / 'u'))
+  assert units == ['unity_0.cpp', 'unity_1.cpp']
+  for unit in units:
+    assert read(tmp_path / 'u' / unit).count('#include') == 1
+
+
+def test_unity_groups_buckets():
+  entries = [('a.cpp', 10, 'a'), ('a.1.cpp', 10, 'a'), ('a.2.cpp', 10, 'a'), ('b.cpp', 5, 'b')]
+  groups = cmacs.unity_groups(entries, buckets=2)
+  assert len(groups) == 3
+  for group in groups:
+    assert len([path for path in group if path.startswith('a.')]) == 1
+  assert cmacs.unity_groups(entries, size=100) == [['a.cpp'], ['a.1.cpp'], ['a.2.cpp', 'b.cpp']]
+
+
+def test_cache_key_depends_on_clang_format(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  cache = ['--format', '--cache', '--cache-dir', str(tmp_path / 'cache')]
+  cmacs.main([src, '--clang-format', fake_clang_format(str(tmp_path), 'first')] + cache)
+  assert read(src + '.hpp').endswith('// first\n')
+  cmacs.main([src, '--clang-format', fake_clang_format(str(tmp_path), 'second')] + cache)
+  assert read(src + '.hpp').endswith('// second\n')
+
+
+def test_check_does_not_write_cache_entries(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  clang_format = ['--format', '--clang-format', fake_clang_format(str(tmp_path))]
+  cmacs.main([src] + clang_format)
+  cmacs.main([src, '--check', '--cache', '--cache-dir', str(tmp_path / 'cache')] + clang_format)
+  assert cmacs.CMacsCache(str(tmp_path / 'cache')).entries() == []
+
+
+@pytest.mark.parametrize('option', ['--split', '--unity-buckets'])
+def test_counts_must_be_positive(tmp_path, option):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  with pytest.raises(SystemExit) as e:
+    cmacs.main([src, option, '0', '--unity', str(tmp_path / 'u')])
+  assert e.value.code == 2
+
+
+def test_serve_formats_returned_file_outputs(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  defaults = cmacs.argparse.Namespace(here=False, format=True, namespace=None, clang_format=fake_clang_format(str(tmp_path)), check=False)
+  cache = cmacs.CMacsCache(None, memory=16)
+  for request in ({'path': src, 'write': False}, {'text': SOURCE, 'name': src}):
+    response = cmacs.serve_request(request, defaults, cache)
+    assert response['ok']
+    assert response['hpp'].endswith('// formatted\n')
+    assert response['cpp'].endswith('// formatted\n')
+
+
+def brackets(*lines):
+  f = cmacs.CMacsFile('lex.cm.cpp', False, '')
+  found = [''.join(m.group() for m in f.brackets(line)) for line in lines]
+  return found, f.region
+
+
+@pytest.mark.parametrize('line, expected', [
+  ('f(a[1]) {', '([]){'),
+  ('x(); // { ( [', '()'),
+  ('/* { */ (', '('),
+  ('s = "{(" + t[0];', '[]'),
+  ('s = "a \\" {" + t[0];', '[]'),
+  ("c = '{';", ''),
+  ("c = '\\'' {", '{'),
+  ("c = u8'(' + L'[' {", '{'),
+  ("n = 1'000'000; {", '{'),
+  ("n = 0x1'F; (", '('),
+  ('r = R"(}")"; [', '['),
+  ('r = LR"x()")x" ]', ']'),
+  ('r = u8R"d({)d"; {', '{'),
+  ('a / b [', '['),
+])
+def test_brackets_skip_comments_and_literals(line, expected):
+  assert brackets(line) == ([expected], None)
+
+
+def test_brackets_across_lines():
+  assert brackets('a /* {', '} */ (') == (['', '('], None)
+  assert brackets('r = R"z( {', ')" still raw [', ')z" ]') == (['', '', ']'], None)
+  assert brackets('x /* {') == ([''], '*/')
+
+
+def test_translate_with_comments_and_literals():
+  hpp, cpp = cmacs.translate('''#pragma cmacs class
+class Fmt {
+public:
+  #pragma cmacs method
+  int open() {
+    // unbalanced: {{ ((
+    /* spans lines } ) ]
+    #pragma cmacs method
+    */
+    char c = '}';
+    int n = 1'000;
+    return R"x(})]"{)x"[0];
+  }
+};
+''')
+  assert 'int open ();' in hpp
+  assert hpp.count('#pragma') == 1
+  assert 'return R"x(})]"{)x"[0];' in cpp
+  assert '#pragma cmacs method' in cpp
+
+
+def test_unterminated_comment_is_an_error():
+  with pytest.raises(RuntimeError):
+    cmacs.translate('int a; /* {\n')
+
+
+@pytest.mark.parametrize('args', [
+  ['--stdout', '--stats-json', '-'],
+  ['--cpp-out', '-', '--stats-json', '-'],
+  ['-', '-MD'],
+  ['-', '-MF', 'out.d', '--stdin-name', 'missing.cm.cpp'],
+])
+def test_conflicting_stream_options(tmp_path, args):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  inputs = [] if '-' in args else [src]
+  with pytest.raises(SystemExit) as e:
+    cmacs.main(inputs + args)
+  assert e.value.code == 2
+
+
+def test_pch_keeps_includes_after_defines(tmp_path):
+  sources = []
+  for name in ('a', 'b'):
+    sources.append(write(tmp_path / (name + '.cm.cpp'), '''#pragma cmacs includes
+{
+  #include <string>
+  #define NDEBUG
+  #include <cassert>
+}
+
+#pragma cmacs class
+class ''' + name.upper() + ''' {
+public:
+  #pragma cmacs method
+  int get() { assert(false); return 0; }
+};
+'''))
+  cmacs.main(sources + ['--pch', str(tmp_path / 'pch')])
+  assert read(tmp_path / 'pch' / cmacs.PCH_NAME) == '#pragma once\n#include <string>\n'
+  hpp = read(sources[0] + '.hpp')
+  assert '<string>' not in hpp
+  assert hpp.index('#define NDEBUG') < hpp.index('#include <cassert>')
+
+
+# Stand-in for clang-format that tags texts with the style file of their
+# directory
+STYLED_CLANG_FORMAT = """#!/usr/bin/env python3
+import os, sys
+def style(path):
+  with open(os.path.join(os.path.dirname(os.path.abspath(path)), '.clang-format')) as f:
+    return '// ' + f.read().strip() + '\\n'
+for arg in sys.argv[1:]:
+  if arg.startswith('--assume-filename='):
+    sys.stdout.write(sys.stdin.read() + style(arg[len('--assume-filename='):len(arg)]))
+  elif not arg.startswith('-'):
+    with open(arg, 'a') as f:
+      f.write(style(arg))
+"""
+
+
+def test_cache_key_depends_on_style_file(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  options = ['--format', '--clang-format', write(tmp_path / 'cf', STYLED_CLANG_FORMAT, stat.S_IXUSR), '--cache', '--cache-dir', str(tmp_path / 'cache')]
+  write(tmp_path / '.clang-format', 'one\n')
+  cmacs.main([src] + options)
+  assert read(src + '.hpp').endswith('// one\n')
+  write(tmp_path / '.clang-format', 'two\n')
+  cmacs.main([src] + options)
+  assert read(src + '.hpp').endswith('// two\n')
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(tmp_path, *args):
+  sock = str(tmp_path / 'cmacs.sock')
+  server = subprocess.Popen([sys.executable, os.path.join(HERE, 'cmacs.py'), '--serve', '--socket', sock] + list(args))
+  for i in range(100):
+    if os.path.exists(sock):
+      break
+    time.sleep(0.05)
+  return server, sock
+
+
+def run_client(*args):
+  return subprocess.run([sys.executable, os.path.join(HERE, 'cmacs_client.py')] + list(args), stderr=subprocess.PIPE, text=True, timeout=60)
+
+
+def test_client_does_not_deadlock_on_many_files(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  server, sock = start_server(tmp_path)
+  try:
+    assert run_client('--socket', sock, *[src] * 6000).returncode == 0
+  finally:
+    server.kill()
+    server.wait()
+
+
+def test_client_keeps_server_format(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  server, sock = start_server(tmp_path, '--format', '--clang-format', fake_clang_format(str(tmp_path)))
+  try:
+    assert run_client('--socket', sock, src).returncode == 0
+    assert read(src + '.hpp').endswith('// formatted\n')
+  finally:
+    server.kill()
+    server.wait()
+
+
+def test_client_rejects_unknown_options(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  client = run_client('-MD', src)
+  assert client.returncode == 2
+  assert 'unknown option -MD' in client.stderr
+  assert not os.path.exists(src + '.hpp')
+
+
+def test_redirected_outputs_keep_old_shards(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  cmacs.main([src, '--split', '3'])
+  shards = [src + '.1.cpp', src + '.2.cpp']
+  cmacs.main([src, '--hpp-out', os.devnull, '--cpp-out', os.devnull])
+  assert all(os.path.exists(shard) for shard in shards)
+
+
+def test_watch_latency_counts_from_the_write(tmp_path):
+  watcher = cmacs.CMacsPoller([str(tmp_path)], interval=0.05)
+  # File timestamps come from a coarser clock than time.time()
+  time.sleep(0.05)
+  written = write(tmp_path / 'a.cm.cpp', SOURCE)
+  moved = write(tmp_path / 'b.cm.cpp', SOURCE)
+  os.utime(moved, (0, 0))
+  time.sleep(0.2)
+  assert sorted(watcher.poll(None)) == [written, moved]
+  assert cmacs.changed_at(written, watcher) == os.stat(written).st_mtime
+  assert cmacs.changed_at(moved, watcher) == watcher.since
+  assert time.time() - cmacs.changed_at(written, watcher) >= 0.2
+
+
+INSTANTIATE = '''#pragma cmacs includes
+{
+  #include <array>
+}
+
+#pragma cmacs class
+class Buf {
+public:
+  #pragma cmacs method instantiate int "long, 5" "short, 2+1" "char, 2, 3"
+  template <typename T, int N = 3, int M = N * 2, typename U = std::array<T,M>>
+  U make(T fill) {
+    U a;
+    a.fill(fill + N);
+    return a;
+  }
+};
+'''
+
+
+def test_instantiate_fills_in_defaults():
+  hpp, cpp = cmacs.translate(INSTANTIATE, name='buf.cm.cpp')
+  assert 'extern template std::array<int,(3 * 2)> Buf::make<int, 3, 3 * 2, std::array<int,(3 * 2)> > (int fill);' in hpp
+  assert 'template std::array<short,((2+1) * 2)> Buf::make<short, 2+1, (2+1) * 2, std::array<short,((2+1) * 2)> > (short fill);' in cpp
+  assert 'template std::array<char,3> Buf::make<char, 2, 3, std::array<char,3> > (char fill);' in cpp
+
+
+@pytest.mark.parametrize('args', ['""', '"int, 1, 2, std::array<int,2>, 5"'])
+def test_instantiate_checks_argument_count(args):
+  with pytest.raises(RuntimeError, match='Expected 1 to 4 template arguments'):
+    cmacs.translate(INSTANTIATE.replace('instantiate int "long, 5"', 'instantiate ' + args + ' "long, 5"'))
+
+
+@pytest.mark.skipif(shutil.which('g++') == None, reason='needs g++')
+def test_instantiations_link(tmp_path):
+  src = write(tmp_path / 'buf.cm.cpp', INSTANTIATE)
+  cmacs.main([src])
+  main = write(tmp_path / 'main.cpp', '''#include "buf.cm.cpp.hpp"
+int main() {
+  Buf b;
+  return b.make(1)[5] + b.make<long, 5>(1L)[9] + b.make<short, 2+1>((short)1)[5] + b.make<char, 2, 3>((char)1)[2] - 4 - 6 - 4 - 3;
+}
+''')
+  # Nothing but the explicit instantiations in buf.cm.cpp.cpp defines make
+  subprocess.run(['g++', '-std=c++17', '-o', str(tmp_path / 'main'), main, src + '.cpp'], check=True)
+  assert subprocess.run([str(tmp_path / 'main')]).returncode == 0
+
+
+@pytest.mark.parametrize('name', ['example.cm.cpp', 'instantiate'])
+def test_emit_ir_matches_translate(name):
+  text = INSTANTIATE if name == 'instantiate' else read(os.path.join(HERE, name))
+  # Cached IRs go through JSON
+  ir = json.loads(json.dumps(cmacs.read_ir(text)))
+  assert cmacs.emit_ir(ir, namespace='Ns') == cmacs.translate(text, namespace='Ns')
+
+
+def test_depfile_lists_generated_headers(tmp_path):
+  write(tmp_path / 'a.cm.cpp', SOURCE)
+  os.mkdir(tmp_path / 'sub dir')
+  src = write(tmp_path / 'sub dir' / 'b.cm.cpp', '''#pragma cmacs includes
+{
+  #include <vector>
+  #include "../a.cm.cpp.hpp"
+  #include "plain.hpp"
+}
+''' + SOURCE.replace('Main', 'Other'))
+  cmacs.main([src, '-MD'])
+  dir = str(tmp_path / 'sub\\ dir')
+  assert read(src + '.d') == dir + '/b.cm.cpp.hpp ' + dir + '/b.cm.cpp.cpp: ' + dir + '/b.cm.cpp ' + str(tmp_path / 'a.cm.cpp.hpp') + '\n'
+  cmacs.main([src, '-MF', str(tmp_path / 'deps.d')])
+  assert read(tmp_path / 'deps.d') == read(src + '.d')
+
+
+def test_fwd_declares_top_level_classes(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE + '''
+#pragma cmacs class
+struct Point {
+  int x;
+
+  #pragma cmacs class
+  class Inner {
+  };
+};
+''')
+  expected = '#pragma once\nnamespace Example {\nclass Main;\nstruct Point;\n}\n'
+  options = ['--fwd', '--cache', '--cache-dir', str(tmp_path / 'cache')]
+  cmacs.main([src] + options)
+  assert read(src + '.fwd.hpp') == expected
+  os.remove(src + '.fwd.hpp')
+  cmacs.main([src] + options)
+  assert read(src + '.fwd.hpp') == expected
+
+
+def test_check_formats_without_writing(tmp_path):
+  src = write(tmp_path / 'example.cm.cpp', SOURCE)
+  # Records how it was called, then formats like the styled stand-in
+  calls = str(tmp_path / 'calls')
+  logging = STYLED_CLANG_FORMAT.replace('import os, sys\n', 'import os, sys\nopen(' + repr(calls) + ', "a").write(repr(sys.argv[1:]) + "\\n")\n')
+  clang_format = ['--format', '--clang-format', write(tmp_path / 'cf', logging, stat.S_IXUSR)]
+  write(tmp_path / '.clang-format', 'one\n')
+  cmacs.main([src] + clang_format)
+  os.remove(calls)
+  cmacs.main([src, '--check'] + clang_format)
+  assert sorted(read(calls).splitlines()) == [repr(['--assume-filename=' + src + suffix]) for suffix in ('.cpp', '.hpp')]
+  write(tmp_path / '.clang-format', 'two\n')
+  with pytest.raises(SystemExit) as e:
+    cmacs.main([src, '--check'] + clang_format)
+  assert e.value.code == 1